@@ -0,0 +1,864 @@
+"""Benchmarks for the medications backend.
+
+Each benchmark is a subcommand, run `python benchmark.py --help` to list them.
+The load benchmarks need a running server, for instance:
+
+    MEDICATIONS_DB_PROFILE=prod fastapi run main.py
+    python benchmark.py load --concurrency 200
+
+    MEDICATIONS_DB_PROFILE=prod fastapi run main_async.py
+    python benchmark.py load --concurrency 200
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, latencies, errors, elapsed):
+    print(f"{name}: {len(latencies)} requests in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.1f} req/s), {errors} errors")
+    if latencies:
+        print(f"  latency ms: mean {statistics.mean(latencies) * 1000:.2f} "
+              f"p50 {percentile(latencies, 50) * 1000:.2f} "
+              f"p99 {percentile(latencies, 99) * 1000:.2f}")
+
+
+def create_load_patient(url):
+    response = requests.post(f"{url}/patients", json={
+        'name': 'Load', 'surname': 'Test', 'code': f"load-{uuid.uuid4()}"})
+    response.raise_for_status()
+    patient_id = response.json()['id']
+    response = requests.post(f"{url}/patients/{patient_id}/medications", json={
+        'name': 'LoadMed', 'dosage': 1.0, 'start_date': "2024-10-01", 'treatment_duration': 30})
+    response.raise_for_status()
+    medication_id = response.json()['id']
+    for hour in (8, 16):
+        requests.post(f"{url}/patients/{patient_id}/medications/{medication_id}/posologies",
+                      json={'hour': hour, 'minute': 0}).raise_for_status()
+    return patient_id, medication_id
+
+
+def load(args):
+    patient_id, medication_id = create_load_patient(args.url)
+    patient_url = f"{args.url}/patients/{patient_id}"
+    medication_url = f"{patient_url}/medications/{medication_id}"
+    requests_mix = [
+        ("get", patient_url, None),
+        ("get", f"{patient_url}/medications", None),
+        ("get", f"{medication_url}/posologies", None),
+        ("get", f"{patient_url}/intakes", None),
+        ("post", f"{medication_url}/intakes", {'date': "2024-10-02T08:00"}),
+    ]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker(n):
+        nonlocal errors
+        local_latencies = []
+        local_errors = 0
+        with requests.Session() as http:
+            i = n
+            while time.perf_counter() < deadline:
+                method, url, body = requests_mix[i % len(requests_mix)]
+                i += 1
+                start = time.perf_counter()
+                response = http.request(method, url, json=body)
+                local_latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    report(f"load concurrency={args.concurrency}",
+           latencies, errors, time.perf_counter() - start)
+    requests.delete(patient_url)
+
+
+def intake_batch(args):
+    patient_id, medication_id = create_load_patient(args.url)
+    patient_url = f"{args.url}/patients/{patient_id}"
+    base_date = datetime.datetime(2024, 10, 1)
+    dates = [(base_date + datetime.timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M")
+             for i in range(args.intakes)]
+
+    with requests.Session() as http:
+        start = time.perf_counter()
+        for date in dates:
+            http.post(f"{patient_url}/medications/{medication_id}/intakes",
+                      json={'date': date}).raise_for_status()
+        elapsed = time.perf_counter() - start
+        print(f"per-row: {args.intakes} intakes in {elapsed:.2f}s "
+              f"({args.intakes / elapsed:.0f} intakes/s)")
+
+        start = time.perf_counter()
+        for i in range(0, len(dates), args.batch_size):
+            http.post(f"{patient_url}/intakes", json=[
+                {'medication_id': medication_id, 'date': date}
+                for date in dates[i:i + args.batch_size]]).raise_for_status()
+        elapsed = time.perf_counter() - start
+        print(f"batch of {args.batch_size}: {args.intakes} intakes in {elapsed:.2f}s "
+              f"({args.intakes / elapsed:.0f} intakes/s)")
+    requests.delete(patient_url)
+
+
+def dates(args):
+    # Same intake table with text dates and with epoch-minute dates, built
+    # directly with sqlite3 so only the storage differs
+    base_date = datetime.datetime(2024, 1, 1)
+    rows_per_medication = args.rows // args.medications
+    storages = {
+        "text": ("VARCHAR", lambda minutes: (base_date + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M")),
+        "integer": ("INTEGER", lambda minutes: (base_date - datetime.datetime(1970, 1, 1)) // datetime.timedelta(minutes=1) + minutes),
+    }
+    rng = random.Random(args.seed)
+    windows = [(rng.randrange(args.medications), rng.randrange(rows_per_medication * 480))
+               for _ in range(args.queries)]
+    with tempfile.TemporaryDirectory() as directory:
+        for storage, (column_type, convert) in storages.items():
+            path = os.path.join(directory, f"{storage}.db")
+            connection = sqlite3.connect(path)
+            connection.execute(
+                f"CREATE TABLE intake (id INTEGER PRIMARY KEY, date {column_type} NOT NULL, medication_id INTEGER NOT NULL)")
+            start = time.perf_counter()
+            for medication_id in range(args.medications):
+                connection.executemany(
+                    "INSERT INTO intake (date, medication_id) VALUES (?, ?)",
+                    ((convert(i * 480), medication_id) for i in range(rows_per_medication)))
+            connection.execute(
+                "CREATE INDEX ix_intake_medication_id_date ON intake (medication_id, date)")
+            connection.commit()
+            insert_time = time.perf_counter() - start
+            size = os.path.getsize(path)
+
+            # 30 days windows
+            start = time.perf_counter()
+            found = 0
+            for medication_id, minutes in windows:
+                found += len(connection.execute(
+                    "SELECT id, date FROM intake WHERE medication_id = ? AND date >= ? AND date <= ?",
+                    (medication_id, convert(minutes), convert(minutes + 30 * 1440))).fetchall())
+            query_time = time.perf_counter() - start
+            connection.close()
+            print(f"{storage}: {args.rows} rows, {size / 2 ** 20:.1f} MiB, "
+                  f"insert+index {insert_time:.2f}s, {args.queries} range scans "
+                  f"{query_time * 1000 / args.queries:.3f} ms/scan ({found} rows)")
+
+
+def pagination(args):
+    # Deep pages of the patient list with OFFSET (start_index) and with the
+    # keyset cursor, through crud.find_patient on a temporary SQLite database
+    from sqlmodel import Session, SQLModel
+
+    from sql_app import crud
+    from sql_app.database import PROFILES, create_db_engine
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'pagination.db')}", PROFILES["bench"])
+        SQLModel.metadata.create_all(db_engine)
+        connection = db_engine.raw_connection()
+        connection.executemany(
+            "INSERT INTO patient (id, name, surname, code) VALUES (?, ?, ?, ?)",
+            ((i, "Name", "Surname", f"code-{i}") for i in range(1, args.patients + 1)))
+        connection.commit()
+        connection.close()
+
+        with Session(db_engine) as session:
+            for depth in range(0, args.patients, args.patients // args.depths):
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    offset_page = crud.find_patient(session, start_index=depth, count=args.count)
+                offset_time = (time.perf_counter() - start) / args.repeat
+                # The cursor of the page at this depth is the id of the last
+                # row of the previous page
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    cursor_page = crud.find_patient(session, after=(depth,), count=args.count)
+                cursor_time = (time.perf_counter() - start) / args.repeat
+                assert [patient.id for patient in offset_page] == [patient.id for patient in cursor_page]
+                print(f"page at row {depth}: offset {offset_time * 1000:.3f} ms, "
+                      f"cursor {cursor_time * 1000:.3f} ms")
+        db_engine.dispose()
+
+
+def startup(args):
+    # Time from launching the server until it answers a request, on a
+    # database already seeded with args.patients patients
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.seed import seed_db
+    from sql_app.utils import create_db_and_tables
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'startup.db')}"
+        db_engine = create_db_engine(url, PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        seed_db(db_engine, patients=args.patients)
+        db_engine.dispose()
+
+        env = dict(os.environ, MEDICATIONS_DB_URL=url, MEDICATIONS_DB_PROFILE="prod")
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", args.app, "--port", str(args.port),
+                 "--workers", str(args.workers)],
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        if requests.get(f"http://127.0.0.1:{args.port}/patients?count=1").ok:
+                            break
+                    except requests.ConnectionError:
+                        pass
+                    if server.poll() is not None:
+                        raise RuntimeError("The server exited during startup")
+                    time.sleep(0.01)
+                times.append(time.perf_counter() - start)
+            finally:
+                server.terminate()
+                server.wait()
+        print(f"startup of {args.app} with {args.workers} workers, {args.patients} patients: "
+              f"mean {statistics.mean(times):.2f}s max {max(times):.2f}s")
+
+
+def catalogue(args):
+    # Load time and memory of the catalogue, and latency of searches in
+    # process: prefixes of names and misspelled words
+    import json
+    import shutil
+    import tracemalloc
+    from sql_app.catalogue import CATALOGUE_PATH, artifact_path, load_catalogue
+
+    # Loading the JSON file as a list of dicts, compiling the catalogue and
+    # mapping the compiled catalogue, in a copy of medications.json
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(CATALOGUE_PATH))
+        shutil.copy(CATALOGUE_PATH, path)
+        tracemalloc.start()
+        start = time.perf_counter()
+        with open(path, 'r', encoding='utf8') as f:
+            entries = json.load(f)
+        elapsed = time.perf_counter() - start
+        print(f"json.load: {elapsed * 1000:.1f} ms, "
+              f"{tracemalloc.get_traced_memory()[0] / 2 ** 20:.2f} MiB of objects")
+        del entries
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        load_catalogue(path)
+        print(f"compile: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        tracemalloc.start()
+        memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        medications_catalogue = load_catalogue(path)
+        elapsed = time.perf_counter() - start
+        print(f"mapped: {elapsed * 1000:.2f} ms, "
+              f"{(tracemalloc.get_traced_memory()[0] - memory) / 2 ** 10:.1f} KiB of objects, "
+              f"{os.path.getsize(artifact_path(path)) / 2 ** 20:.2f} MiB shared file")
+        tracemalloc.stop()
+
+    rng = random.Random(args.seed)
+    names = medications_catalogue.names
+    queries = {"prefix": [], "misspelled": []}
+    for _ in range(args.queries):
+        word = rng.choice(names).split()[0].lower()
+        queries["prefix"].append(word[:rng.randint(1, len(word))])
+        if len(word) > 3:
+            i = rng.randrange(len(word) - 1)
+            word = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+        queries["misspelled"].append(word)
+    for kind, kind_queries in queries.items():
+        latencies = []
+        for query in kind_queries:
+            start = time.perf_counter()
+            medications_catalogue.search(query, limit=args.limit)
+            latencies.append(time.perf_counter() - start)
+        print(f"{kind}: {len(latencies)} searches, latency us: "
+              f"mean {statistics.mean(latencies) * 1e6:.1f} "
+              f"p50 {percentile(latencies, 50) * 1e6:.1f} "
+              f"p99 {percentile(latencies, 99) * 1e6:.1f}")
+
+
+def schedule(args):
+    # Expansion of the schedule of a patient with many medications, in
+    # process. Memory stays flat however long the period is
+    import tracemalloc
+    from sql_app.models import Medication, Posology
+    from sql_app.schedule import iter_schedule
+
+    rng = random.Random(args.seed)
+    medications = []
+    for medication_id in range(args.medications):
+        start_date = datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(args.days))
+        medication = Medication(id=medication_id, name=f"Med{medication_id}", patient_id=1,
+                                start_date=start_date.isoformat(), treatment_duration=args.days)
+        hours = rng.sample(range(24), args.posologies)
+        medications.append((medication, [Posology(id=medication_id * 24 + hour, hour=hour, minute=0,
+                                                  medication_id=medication_id) for hour in hours]))
+    end_date = (datetime.datetime(2024, 1, 1) + datetime.timedelta(days=2 * args.days)).strftime("%Y-%m-%dT%H:%M")
+
+    start = time.perf_counter()
+    doses = 0
+    for rows in iter_schedule(medications, "2024-01-01T00:00", end_date):
+        doses += len(rows)
+    elapsed = time.perf_counter() - start
+
+    # Again to measure the memory, tracemalloc slows it down
+    tracemalloc.start()
+    for rows in iter_schedule(medications, "2024-01-01T00:00", end_date):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{args.medications} medications x {args.posologies} posologies, {args.days} days: "
+          f"{doses} doses in {elapsed:.2f}s ({doses / elapsed:.0f} doses/s), "
+          f"peak memory {peak / 2 ** 10:.0f} KiB")
+
+
+def nested_loop_adherence(doses, intakes, tolerance):
+    # Reference implementation: every dose scans all the intakes
+    used = set()
+    counts = {"taken": 0, "missed": 0}
+    for dose in doses:
+        for i, intake in enumerate(intakes):
+            if i not in used and abs(intake - dose) <= tolerance:
+                used.add(i)
+                counts["taken"] += 1
+                break
+        else:
+            counts["missed"] += 1
+    return counts
+
+
+def adherence(args):
+    # Adherence of a medication taken 4 times a day for years, with the
+    # intake jitter and skipped doses of the seed data, in process
+    from sql_app.adherence import match_doses
+
+    rng = random.Random(args.seed)
+    doses = [day * 1440 + hour * 60 for day in range(args.days) for hour in (2, 8, 14, 20)]
+    intakes = [dose + rng.randint(-60, 60) for dose in doses if rng.random() >= 0.2]
+    intakes.sort()
+
+    start = time.perf_counter()
+    counts = match_doses(doses, intakes, 60)
+    elapsed = time.perf_counter() - start
+    print(f"sort-merge: {len(doses)} doses, {len(intakes)} intakes in {elapsed * 1000:.1f} ms "
+          f"({counts['taken']} taken, {counts['late']} late, {counts['missed']} missed)")
+
+    if args.nested_loop_days:
+        doses = doses[:args.nested_loop_days * 4]
+        intakes = [intake for intake in intakes if intake < args.nested_loop_days * 1440]
+        start = time.perf_counter()
+        counts = nested_loop_adherence(doses, intakes, 60)
+        elapsed = time.perf_counter() - start
+        print(f"nested loops: {len(doses)} doses, {len(intakes)} intakes in {elapsed * 1000:.1f} ms "
+              f"({counts['taken']} taken, {counts['missed']} missed)")
+
+
+def raw_daily_adherence(session):
+    # Reference implementation: clinic-wide daily adherence computed from
+    # the intakes, posologies and medications on every request
+    from collections import Counter
+    from sqlalchemy import func, select
+    from sql_app.models import Intake, Medication, Posology
+    from sql_app.summary import intake_day_expression, treatment_days
+
+    day = intake_day_expression(session.get_bind().dialect.name)
+    taken = {(medication_id, intake_day): count for medication_id, intake_day, count in session.execute(
+        select(Intake.medication_id, day, func.count()).group_by(Intake.medication_id, day))}
+    expected = Counter()
+    taken_by_day = Counter()
+    statement = select(Medication, func.count(Posology.id)).join(
+        Posology, Posology.medication_id == Medication.id).group_by(Medication.id)
+    for medication, posologies in session.execute(statement):
+        for treatment_day in treatment_days(medication):
+            expected[treatment_day] += posologies
+            taken_by_day[treatment_day] += min(taken.get((medication.id, treatment_day), 0), posologies)
+    return [(treatment_day, expected[treatment_day], taken_by_day[treatment_day]) for treatment_day in sorted(expected)]
+
+
+def summary(args):
+    # Clinic-wide daily adherence from the summary table vs from the
+    # intakes, and time to rebuild the summary, on a seeded database
+    from sqlmodel import Session
+    from sql_app import crud
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.seed import seed_db
+    from sql_app.summary import rebuild_daily_adherence
+    from sql_app.utils import create_db_and_tables
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'summary.db')}", PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        counts = seed_db(db_engine, patients=args.patients)
+        print(", ".join(f"{count} {table}" for table, count in counts.items()))
+        with Session(db_engine) as session:
+            results = []
+            for name, query in (("summary", lambda: crud.find_daily_adherence(session)),
+                                ("intakes", lambda: raw_daily_adherence(session))):
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    rows = [tuple(row) for row in query()]
+                elapsed = (time.perf_counter() - start) / args.repeat
+                results.append(rows)
+                print(f"daily adherence from the {name}: {len(rows)} days in {elapsed * 1000:.1f} ms")
+            assert results[0] == results[1]
+
+            # A month of the dashboard of a patient
+            patient_id = args.patients // 2
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                crud.find_daily_adherence(session, patient_id=patient_id, start_date="2024-11-01", end_date="2024-11-30")
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(f"a month of a patient from the summary: {elapsed * 1000:.2f} ms")
+
+            start = time.perf_counter()
+            rows = rebuild_daily_adherence(session)
+            session.commit()
+            print(f"rebuild: {rows} rows in {time.perf_counter() - start:.2f}s")
+        db_engine.dispose()
+
+
+def cohort(args):
+    # Clinic-wide analytics in a few aggregation queries vs a request per
+    # patient, on a seeded database. The defaults are 100k patients and
+    # about 50M intakes, seeding them takes a while
+    from sqlmodel import Session
+    from sql_app import crud
+    from sql_app.adherence import DEFAULT_TOLERANCE, adherence_period, patient_adherence
+    from sql_app.cache import LRUCache
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.seed import seed_db
+    from sql_app.utils import create_db_and_tables
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'cohort.db')}", PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        start = time.perf_counter()
+        counts = seed_db(db_engine, patients=args.patients, intake_days=args.intake_days)
+        print(", ".join(f"{count} {table}" for table, count in counts.items()) +
+              f" seeded in {time.perf_counter() - start:.0f}s")
+        with Session(db_engine) as session:
+            cache = LRUCache(1, 60)
+            for attempt in ("uncached", "cached"):
+                start = time.perf_counter()
+                result = cache.get("cohort")
+                if result is None:
+                    result = crud.find_cohort_analytics(session, tolerance=DEFAULT_TOLERANCE, limit=10)
+                    cache.set("cohort", result)
+                print(f"cohort analytics, {attempt}: {result['patients']} patients in "
+                      f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+            # The adherence of each patient, as GET /patients/{id}/adherence
+            # would compute it, for a sample of the patients
+            patient_ids = [patient.id for patient in crud.find_patient(session, count=args.sample)]
+            start = time.perf_counter()
+            for patient_id in patient_ids:
+                period = adherence_period("2024-01-01T00:00", "2025-12-31T00:00", DEFAULT_TOLERANCE)
+                medications = crud.find_medications_with_posologies(session, patient_id)
+                intake_dates = crud.find_intake_dates(session, patient_id, start_date=period[2], end_date=period[3])
+                patient_adherence(medications, intake_dates, period[0], period[1], DEFAULT_TOLERANCE)
+            elapsed = time.perf_counter() - start
+            print(f"per patient: {len(patient_ids)} patients in {elapsed:.2f}s, "
+                  f"{elapsed * counts['patients'] / len(patient_ids):.0f}s for all of them")
+        db_engine.dispose()
+
+
+def cache(args):
+    # Polling of the medications and posologies of random patients, as the
+    # mobile app does, in process with and without the read cache
+    from sqlmodel import Session
+    from sql_app import crud
+    from sql_app.cache import CACHE_TTL, LRUCache, caches
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.seed import seed_db
+    from sql_app.utils import create_db_and_tables
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'cache.db')}", PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        seed_db(db_engine, patients=args.patients)
+        rng = random.Random(args.seed)
+        patient_ids = [rng.randint(1, args.patients) for _ in range(args.requests)]
+        for name, maxsize in (("no cache", 0), ("cache", args.patients * 10)):
+            caches[db_engine] = LRUCache(maxsize, CACHE_TTL)
+            start = time.perf_counter()
+            for patient_id in patient_ids:
+                with Session(db_engine) as session:
+                    crud.find_patient(session, patient_id=patient_id)
+                    for medication in crud.find_medications(session, patient_id):
+                        crud.find_medication(session, patient_id, medication.id)
+                        crud.find_posologies(session, patient_id, medication.id)
+            elapsed = time.perf_counter() - start
+            metrics = caches[db_engine].metrics()
+            print(f"{name}: {args.requests} polls in {elapsed:.2f}s "
+                  f"({elapsed / args.requests * 1000:.3f} ms each), "
+                  f"{metrics['hits']} hits, {metrics['misses']} misses")
+        db_engine.dispose()
+
+
+def remove(args):
+    # Deletion of a patient against the size of its history, with the ORM
+    # cascade of the relationships (one DELETE per loaded row) and with the
+    # set-based deletes of crud.remove_patient
+    from sqlalchemy import select
+    from sqlmodel import Session
+    from sql_app import crud
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.models import Intake, Medication, Patient, Posology
+    from sql_app.summary import remove_summary
+    from sql_app.utils import create_db_and_tables
+
+    def create_patient(session, code, intakes):
+        patient_id = crud.insert_patient(session, Patient(code=code)).id
+        base_date = datetime.datetime(2024, 10, 1)
+        for i in range(args.medications):
+            medication = crud.insert_medication(session, Medication(
+                name=f"Med{i}", start_date="2024-10-01", treatment_duration=365, patient_id=patient_id))
+            for hour in (8, 20):
+                crud.insert_posology(session, Posology(hour=hour, minute=0, medication_id=medication.id))
+            crud.insert_intakes(session, [
+                Intake(date=(base_date + datetime.timedelta(minutes=j)).strftime("%Y-%m-%dT%H:%M"),
+                       medication_id=medication.id)
+                for j in range(intakes // args.medications)])
+        return patient_id
+
+    def orm_cascade(session, patient_id):
+        remove_summary(session, select(Medication.id).where(Medication.patient_id == patient_id))
+        session.delete(session.get(Patient, patient_id))
+        session.commit()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'remove.db')}", PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        for intakes in args.intakes:
+            for name, function in (("orm cascade", orm_cascade), ("set-based", crud.remove_patient)):
+                with Session(db_engine) as session:
+                    patient_id = create_patient(session, f"{name}-{intakes}", intakes)
+                    session.expunge_all()
+                    start = time.perf_counter()
+                    function(session, patient_id)
+                    elapsed = time.perf_counter() - start
+                print(f"{name}: patient with {intakes} intakes deleted in {elapsed * 1000:.1f} ms")
+        db_engine.dispose()
+
+
+def update(args):
+    # PATCH of medications in process: load, modify, commit and refresh
+    # (the previous update_medication_data) against the single UPDATE of
+    # crud.update_medication_data. The read cache is disabled so that both
+    # read the database
+    from sqlalchemy import event
+    from sqlmodel import Session, select
+    from sql_app import crud
+    from sql_app.cache import CACHE_TTL, LRUCache, caches
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.models import Medication, MedicationUpdate
+    from sql_app.seed import seed_db
+    from sql_app.utils import create_db_and_tables
+    from sql_app.versions import bump_versions
+
+    def load_modify_refresh(session, patient_id, medication_id, dosage):
+        medication = session.exec(select(Medication).where(
+            Medication.patient_id == patient_id, Medication.id == medication_id)).first()
+        medication.dosage = dosage
+        session.add(medication)
+        bump_versions(session, [patient_id])
+        session.commit()
+        session.refresh(medication)
+
+    def single_update(session, patient_id, medication_id, dosage):
+        crud.update_medication_data(session, patient_id, medication_id, MedicationUpdate(dosage=dosage))
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'update.db')}", PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        seed_db(db_engine, patients=args.patients)
+        caches[db_engine] = LRUCache(0, CACHE_TTL)
+        with Session(db_engine) as session:
+            medications = session.exec(select(Medication.patient_id, Medication.id)).all()
+        rng = random.Random(args.seed)
+        targets = [rng.choice(medications) for _ in range(args.updates)]
+        statements = [0]
+
+        def count_statement(*_):
+            statements[0] += 1
+        event.listen(db_engine, "before_cursor_execute", count_statement)
+        for name, function in (("load-modify-refresh", load_modify_refresh), ("single update", single_update)):
+            statements[0] = 0
+            start = time.perf_counter()
+            for i, (patient_id, medication_id) in enumerate(targets):
+                with Session(db_engine) as session:
+                    function(session, patient_id, medication_id, 1.0 + i % 4)
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {args.updates} updates in {elapsed:.2f}s "
+                  f"({elapsed / args.updates * 1000:.3f} ms each, {statements[0] / args.updates:.1f} statements)")
+        db_engine.dispose()
+
+
+def insert(args):
+    # Inserts of intakes in process as in POST .../intakes, with sessions
+    # that expire their objects on commit and refresh the row inserted (as
+    # before), and with the sessions of the requests, which keep them
+    from sqlalchemy import event
+    from sqlmodel import Session
+    from sql_app import crud
+    from sql_app.database import PROFILES, create_db_engine
+    from sql_app.models import Intake, Medication, Patient
+    from sql_app.utils import create_db_and_tables
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'insert.db')}", PROFILES["bench"])
+        create_db_and_tables(db_engine)
+        with Session(db_engine) as session:
+            patient_id = crud.insert_patient(session, Patient(code="insert")).id
+            medication_id = crud.insert_medication(session, Medication(
+                name="Med", start_date="2024-10-01", treatment_duration=365, patient_id=patient_id)).id
+        base_date = datetime.datetime(2024, 10, 1)
+        statements = [0]
+
+        def count_statement(*_):
+            statements[0] += 1
+        event.listen(db_engine, "before_cursor_execute", count_statement)
+        for name, expire_on_commit in (("refresh", True), ("no refresh", False)):
+            statements[0] = 0
+            start = time.perf_counter()
+            for i in range(args.intakes):
+                with Session(db_engine, expire_on_commit=expire_on_commit) as session:
+                    crud.find_medication(session, patient_id, medication_id)
+                    date = (base_date + datetime.timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M")
+                    intake = crud.insert_intake(session, Intake(date=date, medication_id=medication_id))
+                    if expire_on_commit:
+                        session.refresh(intake)
+                    intake.model_dump()
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {args.intakes} intakes in {elapsed:.2f}s "
+                  f"({elapsed / args.intakes * 1000:.3f} ms each, {statements[0] / args.intakes:.1f} statements)")
+        db_engine.dispose()
+
+
+def conditional(args):
+    # Polling of the intakes of a patient that does not change, with and
+    # without revalidating the previous response with its ETag
+    patient_id, medication_id = create_load_patient(args.url)
+    patient_url = f"{args.url}/patients/{patient_id}"
+    base_date = datetime.datetime(2024, 10, 1)
+    requests.post(f"{patient_url}/intakes", json=[
+        {'medication_id': medication_id,
+         'date': (base_date + datetime.timedelta(hours=12 * i)).strftime("%Y-%m-%dT%H:%M")}
+        for i in range(args.intakes)]).raise_for_status()
+
+    with requests.Session() as http:
+        for name, conditional_headers in (("unconditional", False), ("if-none-match", True)):
+            latencies = []
+            errors = 0
+            received = 0
+            headers = {}
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                request_start = time.perf_counter()
+                response = http.get(f"{patient_url}/intakes", headers=headers)
+                latencies.append(time.perf_counter() - request_start)
+                if response.status_code >= 400:
+                    errors += 1
+                received += len(response.content)
+                if conditional_headers and "ETag" in response.headers:
+                    headers = {"If-None-Match": response.headers["ETag"]}
+            report(name, latencies, errors, time.perf_counter() - start)
+            print(f"  {received / args.requests:.0f} bytes per response")
+    requests.delete(patient_url)
+
+
+def intake_load(args):
+    # Sustained rate of single intakes posted by many clients at once. Run
+    # it against servers with and without MEDICATIONS_GROUP_COMMIT=1
+    patients = [create_load_patient(args.url) for _ in range(args.patients)]
+    base_date = datetime.datetime(2024, 10, 1)
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker(n):
+        nonlocal errors
+        local_latencies = []
+        local_errors = 0
+        patient_id, medication_id = patients[n % len(patients)]
+        url = f"{args.url}/patients/{patient_id}/medications/{medication_id}/intakes"
+        with requests.Session() as http:
+            i = 0
+            while time.perf_counter() < deadline:
+                date = (base_date + datetime.timedelta(minutes=n * 100000 + i)).strftime("%Y-%m-%dT%H:%M")
+                i += 1
+                start = time.perf_counter()
+                response = http.post(url, json={'date': date})
+                local_latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    report(f"intake-load concurrency={args.concurrency}",
+           latencies, errors, time.perf_counter() - start)
+    for patient_id, _ in patients:
+        requests.delete(f"{args.url}/patients/{patient_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Medications backend benchmarks")
+    subparsers = parser.add_subparsers(required=True)
+
+    parser_load = subparsers.add_parser(
+        "load", help="Mixed read/write load against a running server")
+    parser_load.add_argument("--url", default="http://127.0.0.1:8000")
+    parser_load.add_argument("--concurrency", type=int, default=50)
+    parser_load.add_argument("--duration", type=float, default=10)
+    parser_load.set_defaults(func=load)
+
+    parser_intake_batch = subparsers.add_parser(
+        "intake-batch", help="Per-row vs batch intake insertion against a running server")
+    parser_intake_batch.add_argument("--url", default="http://127.0.0.1:8000")
+    parser_intake_batch.add_argument("--intakes", type=int, default=2000)
+    parser_intake_batch.add_argument("--batch-size", type=int, default=1000)
+    parser_intake_batch.set_defaults(func=intake_batch)
+
+    parser_dates = subparsers.add_parser(
+        "dates", help="Storage size and range scans of text vs integer intake dates")
+    parser_dates.add_argument("--rows", type=int, default=10000000)
+    parser_dates.add_argument("--medications", type=int, default=1000)
+    parser_dates.add_argument("--queries", type=int, default=2000)
+    parser_dates.add_argument("--seed", type=int, default=0)
+    parser_dates.set_defaults(func=dates)
+
+    parser_pagination = subparsers.add_parser(
+        "pagination", help="Offset vs cursor pagination of the patient list at increasing depths")
+    parser_pagination.add_argument("--patients", type=int, default=1000000)
+    parser_pagination.add_argument("--count", type=int, default=100)
+    parser_pagination.add_argument("--depths", type=int, default=5)
+    parser_pagination.add_argument("--repeat", type=int, default=20)
+    parser_pagination.set_defaults(func=pagination)
+
+    parser_startup = subparsers.add_parser(
+        "startup", help="Time until a new server answers, on a seeded database")
+    parser_startup.add_argument("--app", default="main:app")
+    parser_startup.add_argument("--patients", type=int, default=15000)
+    parser_startup.add_argument("--workers", type=int, default=1)
+    parser_startup.add_argument("--port", type=int, default=8001)
+    parser_startup.add_argument("--repeat", type=int, default=5)
+    parser_startup.set_defaults(func=startup)
+
+    parser_catalogue = subparsers.add_parser(
+        "catalogue", help="Load time, memory and search latency of the catalogue")
+    parser_catalogue.add_argument("--queries", type=int, default=10000)
+    parser_catalogue.add_argument("--limit", type=int, default=10)
+    parser_catalogue.add_argument("--seed", type=int, default=0)
+    parser_catalogue.set_defaults(func=catalogue)
+
+    parser_schedule = subparsers.add_parser(
+        "schedule", help="Schedule expansion of a patient with many medications")
+    parser_schedule.add_argument("--medications", type=int, default=50)
+    parser_schedule.add_argument("--posologies", type=int, default=4)
+    parser_schedule.add_argument("--days", type=int, default=365)
+    parser_schedule.add_argument("--seed", type=int, default=0)
+    parser_schedule.set_defaults(func=schedule)
+
+    parser_adherence = subparsers.add_parser(
+        "adherence", help="Sort-merge vs nested loops matching of intakes to doses")
+    parser_adherence.add_argument("--days", type=int, default=3 * 365)
+    parser_adherence.add_argument("--nested-loop-days", type=int, default=365,
+                                  help="Days matched with nested loops, 0 to skip them")
+    parser_adherence.add_argument("--seed", type=int, default=0)
+    parser_adherence.set_defaults(func=adherence)
+
+    parser_summary = subparsers.add_parser(
+        "summary", help="Daily adherence from the summary table vs from the intakes")
+    parser_summary.add_argument("--patients", type=int, default=5000)
+    parser_summary.add_argument("--repeat", type=int, default=5)
+    parser_summary.set_defaults(func=summary)
+
+    parser_cohort = subparsers.add_parser(
+        "cohort", help="Clinic-wide analytics vs per-patient adherence on a seeded database")
+    parser_cohort.add_argument("--patients", type=int, default=100000)
+    parser_cohort.add_argument("--intake-days", type=int, default=84,
+                               help="Days of intakes of every posology")
+    parser_cohort.add_argument("--sample", type=int, default=1000,
+                               help="Patients whose adherence is computed one by one")
+    parser_cohort.set_defaults(func=cohort)
+
+    parser_cache = subparsers.add_parser(
+        "cache", help="Patient, medication and posology reads with and without the read cache")
+    parser_cache.add_argument("--patients", type=int, default=1000)
+    parser_cache.add_argument("--requests", type=int, default=20000)
+    parser_cache.add_argument("--seed", type=int, default=0)
+    parser_cache.set_defaults(func=cache)
+
+    parser_remove = subparsers.add_parser(
+        "remove", help="Deletion of a patient with the ORM cascade and with set-based deletes")
+    parser_remove.add_argument("--intakes", type=int, nargs="+", default=[1000, 10000, 50000],
+                               help="Intakes of the deleted patient")
+    parser_remove.add_argument("--medications", type=int, default=5)
+    parser_remove.set_defaults(func=remove)
+
+    parser_update = subparsers.add_parser(
+        "update", help="Medication updates with load-modify-refresh and with a single UPDATE")
+    parser_update.add_argument("--patients", type=int, default=1000)
+    parser_update.add_argument("--updates", type=int, default=5000)
+    parser_update.add_argument("--seed", type=int, default=0)
+    parser_update.set_defaults(func=update)
+
+    parser_insert = subparsers.add_parser(
+        "insert", help="Intake inserts with and without refreshing the row inserted")
+    parser_insert.add_argument("--intakes", type=int, default=5000)
+    parser_insert.set_defaults(func=insert)
+
+    parser_conditional = subparsers.add_parser(
+        "conditional", help="Polling of unchanged intakes with and without If-None-Match against a running server")
+    parser_conditional.add_argument("--url", default="http://127.0.0.1:8000")
+    parser_conditional.add_argument("--requests", type=int, default=2000)
+    parser_conditional.add_argument("--intakes", type=int, default=100)
+    parser_conditional.set_defaults(func=conditional)
+
+    parser_intake_load = subparsers.add_parser(
+        "intake-load", help="Concurrent single intake inserts against a running server")
+    parser_intake_load.add_argument("--url", default="http://127.0.0.1:8000")
+    parser_intake_load.add_argument("--concurrency", type=int, default=100)
+    parser_intake_load.add_argument("--duration", type=float, default=10)
+    parser_intake_load.add_argument("--patients", type=int, default=10,
+                                    help="Patients whose medications receive the intakes")
+    parser_intake_load.set_defaults(func=intake_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,588 @@
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from typing import Literal
+from collections import Counter
+import datetime
+
+from main import tags_metadata, lifespan, MAX_INTAKE_BATCH, MAX_CATALOGUE_LIMIT, MAX_ANALYTICS_LIMIT, get_cursor_key, set_next_cursor, stream_schedule, check_version, intake_writer
+from sql_app.adherence import DEFAULT_TOLERANCE, MAX_TOLERANCE, adherence_period, adherence_result, patient_adherence
+from sql_app.analytics import cohort_cache
+from sql_app.cache import engine_cache
+from sql_app.catalogue import get_catalogue
+from sql_app.database import get_async_session, async_session_maker, async_engine
+from sql_app.export import EXPORT_BATCH_SIZE, MEDIA_TYPES, export_header, export_rows
+from sql_app.summary import daily_adherence_result
+from sql_app.pagination import NEXT_CURSOR_HEADER, datetime_key
+from sql_app.versions import etag_headers, version_headers
+from sql_app.models import Patient, Medication, Posology, Message, Intake, PatientUpdate, MedicationUpdate, PosologyUpdate, MedicationIntake, IntakeBatchItem, IntakeBatchResult, CatalogueEntry, Adherence, PatientAdherence, DailyAdherenceSummary, CohortAnalytics, CacheStats
+from sql_app.async_crud import *
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.exc import IntegrityError
+
+# Same API as main.py with async route handlers on the async engine.
+# Run it with `fastapi run main_async.py` to compare both stacks under load.
+
+app = FastAPI(lifespan=lifespan, openapi_tags=tags_metadata)
+
+# Enable CORS
+origins = [
+    "*",
+]
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag", "Last-Modified"],
+)
+
+
+def stream_intakes(export_format: str, headers: dict | None = None, **kwargs) -> StreamingResponse:
+    # The rows are read while the response is being sent, after the
+    # request session has been closed, so the export uses its own session
+    async def generate():
+        yield export_header(export_format)
+        async with async_session_maker() as session:
+            async for rows in iter_intakes_export(session, EXPORT_BATCH_SIZE, **kwargs):
+                yield export_rows(rows, export_format)
+
+    return StreamingResponse(generate(), media_type=MEDIA_TYPES[export_format], headers=headers)
+
+
+# Patients
+
+@app.post("/patients", tags=["patients"],
+          status_code=201,
+          responses={201: {"model": Patient}, 409: {"model": Message}})
+async def add_patient(patient: Patient, session: AsyncSession = Depends(get_async_session)):
+    registered_patient = await insert_patient(session, patient)
+    if registered_patient is not None:
+        return registered_patient
+    else:
+        raise HTTPException(status_code=409, detail="Patient already exists")
+
+
+@app.get("/patients/{patient_id}", tags=["patients"],
+         responses={200: {"model": Patient}, 404: {"model": Message}})
+async def get_patient(patient_id: int, request: Request, response: Response, session: AsyncSession = Depends(get_async_session)):
+    version = await find_patient_version(session, patient_id)
+    headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+    patient = await find_patient(session, patient_id=patient_id, version=version)
+    if patient is not None:
+        return patient
+    else:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+
+@app.get("/patients", tags=["patients"],
+         responses={200: {"model": Patient | list[Patient]}, 404: {"model": Message}})
+async def get_patient_by_code(response: Response, code: str = None, start_index: int = None, count: int = None, cursor: str = None, session: AsyncSession = Depends(get_async_session)):
+    after = get_cursor_key(cursor, (int,))
+    patient = await find_patient(
+        session, code=code, start_index=start_index, count=count, after=after)
+    if patient is not None:
+        if isinstance(patient, list):
+            set_next_cursor(response, patient, count, lambda patient: (patient.id,))
+        return patient
+    else:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+
+@app.patch("/patients/{patient_id}", tags=["patients"],
+           status_code=204,
+           responses={404: {"model": Message}})
+async def update_patient(patient_id: int, patient: PatientUpdate, session: AsyncSession = Depends(get_async_session)):
+    if not await update_patient_data(session, patient_id, patient):
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} could not be updated")
+
+
+@app.delete("/patients/{patient_id}", tags=["patients"],
+            status_code=204,
+            responses={404: {"model": Message}})
+async def delete_patients(patient_id: int, session: AsyncSession = Depends(get_async_session)):
+    if not await remove_patient(session, patient_id):
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+
+
+# Medications
+
+@app.post("/patients/{patient_id}/medications", tags=["medications"],
+          status_code=201,
+          responses={201: {"model": Medication}, 422: {"model": Message}})
+async def add_medication(patient_id: int, medication: Medication, session: AsyncSession = Depends(get_async_session)):
+    try:
+        date = datetime.datetime.strptime(medication.start_date, "%Y-%m-%d")
+        medication.patient_id = patient_id
+        new_medication = await insert_medication(session, medication)
+        if new_medication is not None:
+            return new_medication
+    except ValueError:
+        pass
+    raise HTTPException(
+        status_code=422, detail=f"Medication {medication} could not be inserted: invalid data")
+
+
+@app.get("/patients/{patient_id}/medications/{medication_id}", tags=["medications"],
+         responses={200: {"model": Medication}, 404: {"model": Message}})
+async def get_medication(patient_id: int, medication_id: int, request: Request, response: Response, session: AsyncSession = Depends(get_async_session)):
+    version = await find_patient_version(session, patient_id)
+    headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+    medication = await find_medication(session, patient_id, medication_id, version=version)
+    if medication is not None:
+        return medication
+    else:
+        raise HTTPException(status_code=404, detail="Medication not found")
+
+
+@app.get("/patients/{patient_id}/medications", tags=["medications"],
+         responses={200: {"model": list[Medication]}, 404: {"model": Message}})
+async def get_all_medications(patient_id: int, request: Request, response: Response, count: int = None, cursor: str = None, session: AsyncSession = Depends(get_async_session)):
+    after = get_cursor_key(cursor, (int,))
+    version = await find_patient_version(session, patient_id)
+    headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    medications = await find_medications(session, patient_id, count=count, after=after, version=version)
+    if medications is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+    set_next_cursor(response, medications, count, lambda medication: (medication.id,))
+    return medications
+
+
+@app.patch(("/patients/{patient_id}/medications/{medication_id}"), tags=["medications"],
+           status_code=204,
+           responses={404: {"model": Message}, 422: {"model": Message}})
+async def update_medication(patient_id: int, medication_id: int, medication: MedicationUpdate, session: AsyncSession = Depends(get_async_session)):
+    try:
+        if medication.start_date is not None:
+            datetime.datetime.strptime(medication.start_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format {medication.start_date}. Required format: %Y-%m-%d")
+    if not await update_medication_data(session, patient_id, medication_id, medication):
+        raise HTTPException(
+            status_code=404, detail=f"Medication {medication_id} for patient {patient_id} could not be updated")
+
+
+@app.delete(("/patients/{patient_id}/medications/{medication_id}"), tags=["medications"],
+            status_code=204,
+            responses={404: {"model": Message}})
+async def delete_medications(patient_id: int, medication_id: int, session: AsyncSession = Depends(get_async_session)):
+    if not await remove_medication(session, patient_id, medication_id):
+        raise HTTPException(
+            status_code=404, detail=f"Medication {medication_id} not found for patient {patient_id}")
+
+
+# Posologies
+
+@app.post("/patients/{patient_id}/medications/{medication_id}/posologies", tags=["posologies"],
+          status_code=201,
+          responses={201: {"model": Posology}, 422: {"model": Message}})
+async def add_posology(patient_id: int, medication_id: int, posology: Posology, session: AsyncSession = Depends(get_async_session)):
+    if posology.hour >= 0 and posology.hour < 24 and posology.minute >= 0 and posology.minute < 60:
+        posology.medication_id = medication_id
+        new_posology = await insert_posology(session, posology, patient_id=patient_id)
+        if new_posology is not None:
+            return new_posology
+    raise HTTPException(
+        status_code=422, detail=f"Posology {posology} could not be inserted into medication {medication_id} and patient {patient_id}: invalid data")
+
+
+@app.get("/patients/{patient_id}/medications/{medication_id}/posologies", tags=["posologies"],
+         responses={200: {"model": list[Posology]}, 404: {"model": Message}})
+async def get_posologies(patient_id: int, medication_id: int, request: Request, response: Response, count: int = None, cursor: str = None, session: AsyncSession = Depends(get_async_session)):
+    after = get_cursor_key(cursor, (int,))
+    version = await find_patient_version(session, patient_id)
+    headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    posologies = await find_posologies(session, patient_id, medication_id, count=count, after=after, version=version)
+    if posologies is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} and medication {medication_id} not found")
+    set_next_cursor(response, posologies, count, lambda posology: (posology.id,))
+    return posologies
+
+
+@app.patch(("/patients/{patient_id}/medications/{medication_id}/posologies/{posology_id}"),  tags=["posologies"],
+            status_code=204,
+            responses={404: {"model": Message}, 422: {"model": Message}})
+async def update_posology(patient_id: int, medication_id: int, posology_id: int, posology: PosologyUpdate, session: AsyncSession = Depends(get_async_session)):
+    # Only the fields sent are checked
+    if (posology.hour is None or 0 <= posology.hour < 24) and (posology.minute is None or 0 <= posology.minute < 60):
+        if not await update_posology_data(session, patient_id, medication_id, posology_id, posology):
+            raise HTTPException(
+                status_code=404, detail=f"Posology {posology_id} not found for patient {patient_id} and medication {medication_id}")
+    else:
+        raise HTTPException(
+            status_code=424, detail=f"Posology {posology} could not be updated for medication {medication_id} and patient {patient_id}: invalid data")
+
+
+@app.delete(("/patients/{patient_id}/medications/{medication_id}/posologies/{posology_id}"),  tags=["posologies"],
+            status_code=204,
+            responses={404: {"model": Message}})
+async def delete_posologies(patient_id: int, medication_id: int, posology_id: int, session: AsyncSession = Depends(get_async_session)):
+    posology = await find_posology(session, patient_id, medication_id, posology_id)
+    if posology is not None:
+        await remove_posology(session, posology)
+    else:
+        raise HTTPException(
+            status_code=404, detail=f"Posology {posology_id} not found for patient {patient_id} and medication {medication_id}")
+
+
+@app.post("/patients/{patient_id}/medications/{medication_id}/intakes", tags=["intakes"],
+          status_code=201,
+          responses={201: {"model": Intake}, 404: {"model": Message}, 422: {"model": Message}, 503: {"model": Message}})
+async def add_intake(patient_id: int, medication_id: int, intake: Intake, session: AsyncSession = Depends(get_async_session)):
+    intake.medication_id = medication_id
+    try:
+        date = datetime.datetime.strptime(intake.date, "%Y-%m-%dT%H:%M")
+        # With the version, a medication deleted by another worker is not
+        # found in the cache
+        version = await find_patient_version(session, patient_id)
+        medication = await find_medication(session, patient_id, medication_id, version=version)
+        if medication is not None and intake_writer is not None:
+            try:
+                intake.id = await intake_writer.insert_async(intake)
+                return intake
+            except IntegrityError:
+                # The medication was deleted before the intake was written
+                pass
+            except TimeoutError:
+                raise HTTPException(
+                    status_code=503, detail="The intake could not be written in time, try again later")
+        elif medication is not None:
+            intake = await insert_intake(session, intake)
+            return intake
+        raise HTTPException(
+            status_code=404, detail=f"Medication {medication_id} not found for patient {patient_id}")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format {intake.date}. Required format: %Y-%m-%dT%H:%M")
+
+
+@app.post("/patients/{patient_id}/intakes", tags=["intakes"],
+          responses={200: {"model": list[IntakeBatchResult]}, 404: {"model": Message}, 413: {"model": Message}})
+async def add_intakes(patient_id: int, intakes: list[IntakeBatchItem], session: AsyncSession = Depends(get_async_session)):
+    if len(intakes) > MAX_INTAKE_BATCH:
+        raise HTTPException(
+            status_code=413, detail=f"At most {MAX_INTAKE_BATCH} intakes can be inserted at once")
+    medication_ids = await find_medication_ids(session, patient_id)
+    if len(medication_ids) == 0 and await find_patient(
+            session, patient_id=patient_id, version=await find_patient_version(session, patient_id)) is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+
+    results = []
+    new_intakes = []
+    for item in intakes:
+        try:
+            datetime.datetime.strptime(item.date, "%Y-%m-%dT%H:%M")
+        except ValueError:
+            results.append(IntakeBatchResult(
+                status=422, detail=f"Invalid date format {item.date}. Required format: %Y-%m-%dT%H:%M"))
+            continue
+        if item.medication_id not in medication_ids:
+            results.append(IntakeBatchResult(
+                status=404, detail=f"Medication {item.medication_id} not found for patient {patient_id}"))
+            continue
+        result = IntakeBatchResult(status=201)
+        results.append(result)
+        new_intakes.append((result, Intake(medication_id=item.medication_id, date=item.date)))
+
+    intake_ids = await insert_intakes(session, [intake for _, intake in new_intakes])
+    for (result, _), intake_id in zip(new_intakes, intake_ids):
+        result.id = intake_id
+    return results
+
+
+@app.get("/patients/{patient_id}/medications/{medication_id}/intakes",  tags=["intakes"],
+         responses={200: {"model": list[Intake]}, 404: {"model": Message}, 422: {"model": Message}})
+async def get_intakes_by_patient_and_medication(patient_id: int, medication_id: int, request: Request, response: Response, start_date: str = None, end_date: str = None, count: int = None, cursor: str = None, session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            date = datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        if end_date is not None:
+            date = datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for start_date {start_date}  or end_date {end_date}. Required format: %Y-%m-%dT%H:%M")
+    after = get_cursor_key(cursor, (datetime_key, int))
+    headers = version_headers(patient_id, await find_patient_version(session, patient_id))
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    intakes = await find_intakes(session, medication_id, patient_id=patient_id,
+                           start_date=start_date, end_date=end_date, count=count, after=after)
+    if intakes is None:
+        raise HTTPException(
+            status_code=404, detail=f"Medication {medication_id} for patient {patient_id} not found")
+    set_next_cursor(response, intakes, count, lambda intake: (intake.date, intake.id))
+    return intakes
+
+
+@app.get("/patients/{patient_id}/intakes",  tags=["intakes"],
+         responses={200: {"model": list[MedicationIntake]}, 404: {"model": Message}, 422: {"model": Message}})
+async def get_intakes_by_patient(patient_id: int, request: Request, response: Response, start_date: str = None, end_date: str = None, count: int = None, cursor: str = None, session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            date = datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        if end_date is not None:
+            date = datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for start_date {start_date}  or end_date {end_date}. Required format: %Y-%m-%dT%H:%M")
+    after = get_cursor_key(cursor, (int, datetime_key, int))
+
+    headers = version_headers(patient_id, await find_patient_version(session, patient_id))
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    intakes = await find_intakes_by_patient(
+        session, patient_id, start_date=start_date, end_date=end_date, count=count, after=after)
+    if intakes is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+    # The page size is a number of intakes, a medication can continue in
+    # the next page
+    set_next_cursor(response, [intake for medication in intakes for intake in medication.intakes_by_medication],
+                    count, lambda intake: (intake.medication_id, intake.date, intake.id))
+    return intakes
+
+
+@app.get("/patients/{patient_id}/intakes/export",  tags=["intakes"],
+         response_class=StreamingResponse,
+         responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}, 404: {"model": Message}, 422: {"model": Message}})
+async def export_intakes_by_patient(patient_id: int, request: Request, response: Response, export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"), start_date: str = None, end_date: str = None, session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        if end_date is not None:
+            datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for start_date {start_date}  or end_date {end_date}. Required format: %Y-%m-%dT%H:%M")
+
+    version = await find_patient_version(session, patient_id)
+    headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    if await find_patient(session, patient_id=patient_id, version=version) is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+
+    return stream_intakes(export_format, headers=headers, patient_id=patient_id, start_date=start_date, end_date=end_date)
+
+
+@app.get("/intakes/export",  tags=["intakes"],
+         response_class=StreamingResponse,
+         responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}, 422: {"model": Message}})
+async def export_intakes(export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"), start_date: str = None, end_date: str = None):
+    try:
+        if start_date is not None:
+            datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        if end_date is not None:
+            datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for start_date {start_date}  or end_date {end_date}. Required format: %Y-%m-%dT%H:%M")
+
+    return stream_intakes(export_format, start_date=start_date, end_date=end_date)
+
+
+@app.delete("/patients/{patient_id}/medications/{medication_id}/intakes/{intake_id}",  tags=["intakes"],
+            status_code=204,
+            responses={404: {"model": Message}})
+async def delete_intake(patient_id: int, medication_id: int, intake_id: int, session: AsyncSession = Depends(get_async_session)):
+    intake = await find_intake(session, patient_id, medication_id, intake_id)
+    if intake is not None:
+        await remove_intake(session, intake)
+    else:
+        raise HTTPException(
+            status_code=404, detail=f"Medication {medication_id} not found for patient {patient_id}")
+
+
+@app.get("/patients/{patient_id}/schedule", tags=["posologies"],
+         response_class=StreamingResponse,
+         responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}, 404: {"model": Message}, 422: {"model": Message}})
+async def get_schedule(patient_id: int, request: Request, response: Response, start_date: str = Query(alias="from"), end_date: str = Query(alias="to"), export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"), session: AsyncSession = Depends(get_async_session)):
+    try:
+        datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for from {start_date} or to {end_date}. Required format: %Y-%m-%dT%H:%M")
+    if end_date < start_date:
+        raise HTTPException(
+            status_code=422, detail=f"to {end_date} is before from {start_date}")
+
+    headers = version_headers(patient_id, await find_patient_version(session, patient_id))
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    medications = await find_medications_with_posologies(session, patient_id)
+    if medications is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+
+    return stream_schedule(medications, start_date, end_date, export_format, headers)
+
+
+@app.get("/patients/{patient_id}/adherence", tags=["intakes"],
+         response_model=PatientAdherence,
+         responses={404: {"model": Message}, 422: {"model": Message}})
+async def get_patient_adherence(patient_id: int, request: Request, response: Response, start_date: str = Query(None, alias="from"), end_date: str = Query(None, alias="to"), tolerance: int = Query(DEFAULT_TOLERANCE, ge=0, le=MAX_TOLERANCE), session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        if end_date is not None:
+            datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for from {start_date} or to {end_date}. Required format: %Y-%m-%dT%H:%M")
+
+    # Without to, the adherence is until now and changes with time
+    headers = None
+    if end_date is not None:
+        headers = version_headers(patient_id, await find_patient_version(session, patient_id))
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    medications = await find_medications_with_posologies(session, patient_id)
+    if medications is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+
+    start, end, intake_start_date, intake_end_date = adherence_period(start_date, end_date, tolerance)
+    intake_dates = await find_intake_dates(
+        session, patient_id, start_date=intake_start_date, end_date=intake_end_date)
+    adherence = patient_adherence(medications, intake_dates, start, end, tolerance)
+    return PatientAdherence(
+        patient_id=patient_id,
+        total=adherence_result(sum(adherence.values(), Counter())),
+        medications=[adherence_result(counts, medication_id) for medication_id, counts in adherence.items()])
+
+
+@app.get("/patients/{patient_id}/medications/{medication_id}/adherence", tags=["intakes"],
+         response_model=Adherence,
+         responses={404: {"model": Message}, 422: {"model": Message}})
+async def get_medication_adherence(patient_id: int, medication_id: int, request: Request, response: Response, start_date: str = Query(None, alias="from"), end_date: str = Query(None, alias="to"), tolerance: int = Query(DEFAULT_TOLERANCE, ge=0, le=MAX_TOLERANCE), session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
+        if end_date is not None:
+            datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for from {start_date} or to {end_date}. Required format: %Y-%m-%dT%H:%M")
+
+    # Without to, the adherence is until now and changes with time
+    version = await find_patient_version(session, patient_id)
+    headers = None
+    if end_date is not None:
+        headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    medication = await find_medication(session, patient_id, medication_id, version=version)
+    if medication is None:
+        raise HTTPException(
+            status_code=404, detail=f"Medication {medication_id} not found for patient {patient_id}")
+
+    start, end, intake_start_date, intake_end_date = adherence_period(start_date, end_date, tolerance)
+    posologies = await find_posologies(session, patient_id, medication_id, version=version)
+    intake_dates = await find_intake_dates(
+        session, patient_id, medication_id=medication_id, start_date=intake_start_date, end_date=intake_end_date)
+    adherence = patient_adherence([(medication, posologies)], intake_dates, start, end, tolerance)
+    return adherence_result(adherence[medication_id], medication_id)
+
+
+@app.get("/adherence/daily", tags=["intakes"],
+         response_model=list[DailyAdherenceSummary],
+         responses={404: {"model": Message}, 422: {"model": Message}})
+async def get_daily_adherence(request: Request, response: Response, start_date: str = Query(None, alias="from"), end_date: str = Query(None, alias="to"), patient_id: int = None, session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        if end_date is not None:
+            datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for from {start_date} or to {end_date}. Required format: %Y-%m-%d")
+
+    # Only the adherence of a patient has a version
+    version = None
+    headers = None
+    if patient_id is not None:
+        version = await find_patient_version(session, patient_id)
+        headers = version_headers(patient_id, version)
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+
+    if patient_id is not None and await find_patient(session, patient_id=patient_id, version=version) is None:
+        raise HTTPException(
+            status_code=404, detail=f"Patient {patient_id} not found")
+
+    rows = await find_daily_adherence(session, patient_id=patient_id, start_date=start_date, end_date=end_date)
+    return daily_adherence_result(rows)
+
+
+@app.get("/analytics/cohort", tags=["analytics"],
+         response_model=CohortAnalytics,
+         responses={422: {"model": Message}})
+async def get_cohort_analytics(start_date: str = Query(None, alias="from"), end_date: str = Query(None, alias="to"), tolerance: int = Query(DEFAULT_TOLERANCE, ge=0, le=MAX_TOLERANCE), limit: int = Query(10, ge=1, le=MAX_ANALYTICS_LIMIT), session: AsyncSession = Depends(get_async_session)):
+    try:
+        if start_date is not None:
+            datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        if end_date is not None:
+            datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"Invalid date format for from {start_date} or to {end_date}. Required format: %Y-%m-%d")
+
+    key = (start_date, end_date, tolerance, limit)
+    result = cohort_cache.get(key)
+    if result is None:
+        result = await find_cohort_analytics(session, start_date=start_date, end_date=end_date, tolerance=tolerance, limit=limit)
+        cohort_cache.set(key, result)
+    return result
+
+
+@app.get("/cache/stats", tags=["cache"],
+         response_model=CacheStats)
+async def get_cache_stats():
+    # Of this worker
+    return CacheStats(reads=engine_cache(async_engine.sync_engine).metrics(), analytics=cohort_cache.metrics())
+
+
+@app.get("/catalogue/search", tags=["catalogue"],
+         response_model=list[CatalogueEntry])
+async def search_catalogue(request: Request, response: Response, q: str = Query(min_length=1), laboratory: str = None, limit: int = Query(10, ge=1, le=MAX_CATALOGUE_LIMIT)):
+    headers = etag_headers(get_catalogue().source_hash.hex())
+    not_modified = check_version(request, response, headers)
+    if not_modified is not None:
+        return not_modified
+    return get_catalogue().search(q, laboratory=laboratory, limit=limit)
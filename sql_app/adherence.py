@@ -0,0 +1,90 @@
+import datetime
+import heapq
+import itertools
+from collections import Counter
+
+from .models import Medication, Posology
+from .schedule import from_minutes, posology_doses, to_minutes
+
+
+# Default and maximum minutes between a dose and an intake taken on time
+DEFAULT_TOLERANCE = 60
+MAX_TOLERANCE = 720
+
+OUTCOMES = ("expected", "taken", "late", "missed", "extra")
+
+
+def match_doses(doses, intakes, tolerance: int) -> Counter:
+    # Sort-merge of the minutes of the expected doses and of the intakes of
+    # a medication, both sorted, in O(doses + intakes). A dose is:
+    # - taken: with an intake less than tolerance minutes before or after;
+    # - late: with an intake after that, before the window of the next dose;
+    # - missed: otherwise.
+    # Intakes not matched to any dose are extra.
+    counts = Counter(dict.fromkeys(OUTCOMES, 0))
+    doses = iter(doses)
+    intakes = iter(intakes)
+    dose = next(doses, None)
+    intake = next(intakes, None)
+    while dose is not None:
+        next_dose = next(doses, None)
+        counts["expected"] += 1
+        while intake is not None and intake < dose - tolerance:
+            counts["extra"] += 1
+            intake = next(intakes, None)
+        if intake is not None and intake <= dose + tolerance:
+            counts["taken"] += 1
+            intake = next(intakes, None)
+        elif intake is not None and (next_dose is None or intake < next_dose - tolerance):
+            counts["late"] += 1
+            intake = next(intakes, None)
+        else:
+            counts["missed"] += 1
+        dose = next_dose
+    if intake is not None:
+        counts["extra"] += 1 + sum(1 for _ in intakes)
+    return counts
+
+
+def adherence_period(start_date: str | None, end_date: str | None, tolerance: int) -> tuple[int, int, str, str]:
+    # Minutes of the first and last doses counted, until now by default, and
+    # the dates of the intakes that can match them
+    start = to_minutes(start_date) if start_date is not None else 0
+    if end_date is not None:
+        end = to_minutes(end_date)
+    else:
+        end = to_minutes(datetime.datetime.now().strftime("%Y-%m-%dT%H:%M"))
+    return start, end, from_minutes(start - tolerance), from_minutes(end + tolerance)
+
+
+def medication_adherence(medication: Medication, posologies: list["Posology"], intakes: list[int],
+                         start: int, end: int, tolerance: int) -> Counter:
+    doses = heapq.merge(*(posology_doses(medication, posology, start, end) for posology in posologies))
+    return match_doses(doses, intakes, tolerance)
+
+
+def patient_adherence(medications: list[tuple["Medication", list["Posology"]]], intake_dates: list[tuple[int, str]],
+                      start: int, end: int, tolerance: int) -> dict[int, Counter]:
+    # Adherence of each medication, intake_dates sorted by medication and
+    # date (see crud.find_intake_dates)
+    intakes_by_medication = {
+        medication_id: [to_minutes(date) for _, date in rows]
+        for medication_id, rows in itertools.groupby(intake_dates, key=lambda row: row[0])}
+    return {
+        medication.id: medication_adherence(
+            medication, posologies, intakes_by_medication.get(medication.id, []), start, end, tolerance)
+        for medication, posologies in medications}
+
+
+def adherence_result(counts: Counter, medication_id: int | None = None) -> dict:
+    def percentage(outcome):
+        if counts["expected"] == 0:
+            return 0.0
+        return round(100 * counts[outcome] / counts["expected"], 2)
+
+    return dict(
+        medication_id=medication_id,
+        **{outcome: counts[outcome] for outcome in OUTCOMES},
+        taken_percentage=percentage("taken"),
+        late_percentage=percentage("late"),
+        missed_percentage=percentage("missed"))
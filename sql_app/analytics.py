@@ -0,0 +1,103 @@
+import os
+
+from sqlalchemy import case, func, select
+
+from .cache import LRUCache
+from .models import DailyAdherence, Intake, Medication, Posology
+from .summary import MINUTES_PER_DAY, date_day, intake_minutes_expression, taken_expression
+
+# Clinic-wide analytics of all the patients, aggregated by the database in
+# a few queries: the adherence of each patient and the missed doses of
+# each medication come from the daily adherence summary, the lateness of
+# the intakes from a join of the intakes with the posologies.
+
+# Seconds a result is reused before it is computed again, and results
+# kept, one per combination of parameters
+ANALYTICS_TTL = float(os.environ.get("MEDICATIONS_ANALYTICS_TTL", "300"))
+ANALYTICS_CACHE_SIZE = 100
+
+# Buckets of the adherence distribution, of 10 percentage points
+ADHERENCE_BUCKETS = 10
+
+# Width of the buckets of the lateness histogram, in minutes
+LATENESS_BUCKET = 15
+
+
+cohort_cache = LRUCache(ANALYTICS_CACHE_SIZE, ANALYTICS_TTL)
+
+
+def summary_period(statement, start_date: str | None, end_date: str | None):
+    if start_date is not None:
+        statement = statement.where(DailyAdherence.day >= date_day(start_date))
+    if end_date is not None:
+        statement = statement.where(DailyAdherence.day <= date_day(end_date))
+    return statement
+
+
+def adherence_distribution_statement(**kwargs):
+    # Patients by bucket of the percentage of their expected doses taken
+    per_patient = summary_period(
+        select(Medication.patient_id,
+               func.sum(DailyAdherence.expected).label("expected"),
+               func.sum(taken_expression()).label("taken"))
+        .join(Medication, Medication.id == DailyAdherence.medication_id)
+        .where(DailyAdherence.expected > 0),
+        kwargs.get('start_date', None), kwargs.get('end_date', None)).group_by(Medication.patient_id).subquery()
+    bucket = case((per_patient.c.taken >= per_patient.c.expected, ADHERENCE_BUCKETS - 1),
+                  else_=per_patient.c.taken * ADHERENCE_BUCKETS // per_patient.c.expected)
+    return select(bucket, func.count()).group_by(bucket)
+
+
+def most_missed_statement(**kwargs):
+    # Medications by number of missed doses, of all the patients
+    missed = func.sum(DailyAdherence.expected - taken_expression())
+    return summary_period(
+        select(Medication.name, func.sum(DailyAdherence.expected), missed)
+        .join(Medication, Medication.id == DailyAdherence.medication_id)
+        .where(DailyAdherence.expected > 0),
+        kwargs.get('start_date', None), kwargs.get('end_date', None)).group_by(Medication.name).order_by(
+        missed.desc(), Medication.name).limit(kwargs.get('limit', 10))
+
+
+def lateness_statement(dialect: str, **kwargs):
+    # Intakes by hour of the dose and minutes from the dose, in buckets of
+    # LATENESS_BUCKET minutes. An intake belongs to the nearest posology of
+    # its medication less than tolerance minutes away, at any day, so that
+    # it is counted once however close the posologies are
+    tolerance = kwargs.get('tolerance')
+    start_date = kwargs.get('start_date', None)
+    end_date = kwargs.get('end_date', None)
+    minute = intake_minutes_expression(dialect) % MINUTES_PER_DAY
+    # Between -720 and 719, an intake at 23:50 is 20 minutes early for a
+    # dose at 00:10
+    delay = (minute - (Posology.hour * 60 + Posology.minute) + MINUTES_PER_DAY + MINUTES_PER_DAY // 2) % \
+        MINUTES_PER_DAY - MINUTES_PER_DAY // 2
+    nearest = func.row_number().over(
+        partition_by=Intake.id, order_by=(func.abs(delay), Posology.hour, Posology.minute))
+    statement = select(Posology.hour.label("hour"), delay.label("delay"), nearest.label("nearest")).select_from(
+        Intake).join(Posology, Posology.medication_id == Intake.medication_id).where(
+        delay >= -tolerance, delay <= tolerance)
+    if start_date is not None:
+        statement = statement.where(Intake.date >= f"{start_date}T00:00")
+    if end_date is not None:
+        statement = statement.where(Intake.date <= f"{end_date}T23:59")
+    matches = statement.subquery()
+    # Shifted to be positive, integer division rounds towards zero
+    bucket = (matches.c.delay + MINUTES_PER_DAY // 2) // LATENESS_BUCKET * LATENESS_BUCKET - MINUTES_PER_DAY // 2
+    return select(matches.c.hour, bucket, func.count()).where(matches.c.nearest == 1).group_by(
+        matches.c.hour, bucket).order_by(matches.c.hour, bucket)
+
+
+def cohort_result(distribution: list[tuple[int, int]], most_missed: list[tuple[str, int, int]],
+                  lateness: list[tuple[int, int, int]]) -> dict:
+    patients = dict(distribution)
+    width = 100 // ADHERENCE_BUCKETS
+    return dict(
+        patients=sum(patients.values()),
+        adherence_distribution=[
+            dict(min_percentage=bucket * width, max_percentage=(bucket + 1) * width, patients=patients.get(bucket, 0))
+            for bucket in range(ADHERENCE_BUCKETS)],
+        most_missed=[
+            dict(name=name, expected=expected, missed=missed, missed_percentage=round(100 * missed / expected, 2))
+            for name, expected, missed in most_missed],
+        lateness=[dict(hour=hour, delay=delay, intakes=intakes) for hour, delay, intakes in lateness])
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import crud
+from .models import (Patient, Medication, Posology, Intake, MedicationIntake, PatientUpdate, MedicationUpdate,
+                     PosologyUpdate)
+
+# Async versions of the functions in crud.py. Each one runs its sync
+# counterpart through AsyncSession.run_sync, so the statements are the same
+# in both stacks but the I/O is awaited on the async driver instead of
+# blocking a threadpool worker.
+
+
+async def insert_patient(session: AsyncSession, patient: Patient) -> Patient | None:
+    return await session.run_sync(crud.insert_patient, patient)
+
+
+async def find_patient(session: AsyncSession, **kwargs) -> Patient | None | list["Patient"]:
+    return await session.run_sync(crud.find_patient, **kwargs)
+
+
+async def find_medication(session: AsyncSession, patient_id: int, medication_id: int, **kwargs) -> Medication | None:
+    return await session.run_sync(crud.find_medication, patient_id, medication_id, **kwargs)
+
+
+async def find_medication_ids(session: AsyncSession, patient_id: int) -> set[int]:
+    return await session.run_sync(crud.find_medication_ids, patient_id)
+
+
+async def find_medications(session: AsyncSession, patient_id: int, **kwargs) -> list["Medication"] | None:
+    return await session.run_sync(crud.find_medications, patient_id, **kwargs)
+
+
+async def find_posology(session: AsyncSession, patient_id: int, medication_id: int, posology_id: int) -> Posology | None:
+    return await session.run_sync(crud.find_posology, patient_id, medication_id, posology_id)
+
+
+async def find_posologies(session: AsyncSession, patient_id: int, medication_id: int, **kwargs) -> list["Posology"] | None:
+    return await session.run_sync(crud.find_posologies, patient_id, medication_id, **kwargs)
+
+
+async def insert_medication(session: AsyncSession, medication: Medication) -> Medication | None:
+    return await session.run_sync(crud.insert_medication, medication)
+
+
+async def insert_posology(session: AsyncSession, posology: Posology, **kwargs) -> Posology | None:
+    return await session.run_sync(crud.insert_posology, posology, **kwargs)
+
+
+async def update_posology_data(session: AsyncSession, patient_id: int, medication_id: int, posology_id: int,
+                               posology: PosologyUpdate) -> bool:
+    return await session.run_sync(crud.update_posology_data, patient_id, medication_id, posology_id, posology)
+
+
+async def remove_patient(session: AsyncSession, patient_id: int) -> bool:
+    return await session.run_sync(crud.remove_patient, patient_id)
+
+
+async def remove_medication(session: AsyncSession, patient_id: int, medication_id: int) -> bool:
+    return await session.run_sync(crud.remove_medication, patient_id, medication_id)
+
+
+async def remove_posology(session: AsyncSession, posology: Posology):
+    await session.run_sync(crud.remove_posology, posology)
+
+
+async def update_patient_data(session: AsyncSession, patient_id: int, patient: PatientUpdate) -> bool:
+    return await session.run_sync(crud.update_patient_data, patient_id, patient)
+
+
+async def update_medication_data(session: AsyncSession, patient_id: int, medication_id: int,
+                                 medication: MedicationUpdate) -> bool:
+    return await session.run_sync(crud.update_medication_data, patient_id, medication_id, medication)
+
+
+async def insert_intake(session: AsyncSession, intake: Intake) -> Intake:
+    return await session.run_sync(crud.insert_intake, intake)
+
+
+async def insert_intakes(session: AsyncSession, intakes: list["Intake"]) -> list[int]:
+    return await session.run_sync(crud.insert_intakes, intakes)
+
+
+async def find_intake(session: AsyncSession, patient_id: int, medication_id: int, intake_id: int) -> Intake | None:
+    return await session.run_sync(crud.find_intake, patient_id, medication_id, intake_id)
+
+
+async def find_intakes(session: AsyncSession, medication_id: int, **kwargs) -> list["Intake"] | None:
+    return await session.run_sync(crud.find_intakes, medication_id, **kwargs)
+
+
+async def find_intake_dates(session: AsyncSession, patient_id: int, **kwargs) -> list[tuple[int, str]]:
+    return await session.run_sync(crud.find_intake_dates, patient_id, **kwargs)
+
+
+async def find_medications_with_posologies(session: AsyncSession, patient_id: int) -> list[tuple["Medication", list["Posology"]]] | None:
+    return await session.run_sync(crud.find_medications_with_posologies, patient_id)
+
+
+async def find_intakes_by_patient(session: AsyncSession, patient_id: int, **kwargs) -> list["MedicationIntake"] | None:
+    return await session.run_sync(crud.find_intakes_by_patient, patient_id, **kwargs)
+
+
+async def find_patient_version(session: AsyncSession, patient_id: int):
+    return await session.run_sync(crud.find_patient_version, patient_id)
+
+
+async def find_daily_adherence(session: AsyncSession, **kwargs) -> list[tuple[int, int, int]]:
+    return await session.run_sync(crud.find_daily_adherence, **kwargs)
+
+
+async def find_cohort_analytics(session: AsyncSession, **kwargs) -> dict:
+    return await session.run_sync(crud.find_cohort_analytics, **kwargs)
+
+
+async def iter_intakes_export(session: AsyncSession, batch_size: int, **kwargs):
+    statement = crud.intakes_export_statement(**kwargs)
+    results = await session.stream(statement.execution_options(yield_per=batch_size))
+    async for rows in results.partitions():
+        yield rows
+
+
+async def remove_intake(session: AsyncSession, intake: Intake):
+    await session.run_sync(crud.remove_intake, intake)
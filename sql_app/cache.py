@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+# Read cache of patients, medications and posologies, in front of the
+# find_* functions of crud.py. Entries hold the column values of the rows,
+# and the functions of crud.py that write them delete the entries they
+# change after committing. Entries expire after MEDICATIONS_CACHE_TTL
+# seconds, which bounds how stale a worker can be about the writes of the
+# others unless the cache is shared (MEDICATIONS_CACHE_URL).
+
+# Maximum entries of the cache of each worker, 0 disables it
+CACHE_SIZE = int(os.environ.get("MEDICATIONS_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.environ.get("MEDICATIONS_CACHE_TTL", "60"))
+# A Redis URL, e.g. redis://localhost:6379/0, for a cache shared by all the
+# workers. Needs the redis package
+CACHE_URL = os.environ.get("MEDICATIONS_CACHE_URL", None)
+
+METRICS = ("hits", "misses", "evictions", "invalidations")
+
+
+class LRUCache:
+    # The maxsize most recently used values, for ttl seconds each
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = Counter(dict.fromkeys(METRICS, 0))
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.counts["misses"] += 1
+            return None
+
+    def set(self, key: str, value):
+        if self.maxsize == 0:
+            return
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counts["evictions"] += 1
+
+    def delete(self, *keys: str):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.counts["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self) -> dict:
+        return dict(backend="memory", size=len(self.entries), **self.counts)
+
+
+class RedisCache:
+    # Shared by the workers of all the servers using the same Redis
+    # database. Values are stored in JSON, metrics are of this worker
+
+    def __init__(self, url: str, ttl: float, prefix: str = "medications:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counts = Counter(dict.fromkeys(METRICS, 0))
+
+    def count(self, metric: str, n: int = 1):
+        with self.lock:
+            self.counts[metric] += n
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.count("misses")
+            return None
+        self.count("hits")
+        return json.loads(value)
+
+    def set(self, key: str, value):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def delete(self, *keys: str):
+        if keys:
+            self.count("invalidations", self.client.delete(*(self.prefix + key for key in keys)))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def metrics(self) -> dict:
+        return dict(backend="redis", size=None, **self.counts)
+
+
+def create_cache(url: str | None = CACHE_URL, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+    if url:
+        return RedisCache(url, ttl)
+    return LRUCache(maxsize, ttl)
+
+
+# A cache per engine, so that databases never share entries (as the
+# in-memory databases of the tests)
+caches = weakref.WeakKeyDictionary()
+caches_lock = threading.Lock()
+# Engines whose sessions run on the event loop, as the sync engine of the
+# async engine through run_sync. They always use the in-memory cache: a
+# round trip of the blocking Redis client would stall every request of
+# the loop
+event_loop_engines = weakref.WeakSet()
+
+
+def use_memory_cache(db_engine):
+    with caches_lock:
+        event_loop_engines.add(db_engine)
+
+
+def engine_cache(db_engine):
+    with caches_lock:
+        cache = caches.get(db_engine)
+        if cache is None:
+            url = None if db_engine in event_loop_engines else CACHE_URL
+            cache = caches[db_engine] = create_cache(url)
+        return cache
+
+
+def session_cache(session):
+    return engine_cache(session.get_bind().engine)
+
+
+def patient_key(patient_id: int) -> str:
+    return f"patient:{patient_id}"
+
+
+def medication_key(patient_id: int, medication_id: int) -> str:
+    return f"medication:{patient_id}:{medication_id}"
+
+
+def medications_key(patient_id: int) -> str:
+    return f"medications:{patient_id}"
+
+
+def posologies_key(patient_id: int, medication_id: int) -> str:
+    return f"posologies:{patient_id}:{medication_id}"
+
+
+def attach(session, model, row: dict):
+    # Instance of a cached row in the session, without querying it again
+    instance = model(**row)
+    make_transient_to_detached(instance)
+    return session.merge(instance, load=False)
+
+
+def get_cached(session, model, key: str, version: int | None = None):
+    # An instance, a list of instances or None if the key is not cached. With
+    # the version of the patient (see versions.py) just read, entries cached
+    # at another version are ignored, so that the data returned is never
+    # older than the ETag sent with it, whatever the worker that wrote it
+    entry = session_cache(session).get(key)
+    if entry is None or (version is not None and entry["version"] != version):
+        return None
+    data = entry["data"]
+    if isinstance(data, list):
+        return [attach(session, model, row) for row in data]
+    return attach(session, model, data)
+
+
+def set_cached(session, key: str, value, version: int | None = None):
+    # version is the one read before the value, if known
+    if isinstance(value, list):
+        data = [instance.model_dump() for instance in value]
+    else:
+        data = value.model_dump()
+    session_cache(session).set(key, {"version": version, "data": data})
+
+
+def invalidate(session, *keys: str):
+    session_cache(session).delete(*keys)
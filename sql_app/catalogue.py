@@ -0,0 +1,239 @@
+import bisect
+import functools
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import unicodedata
+from array import array
+from collections import Counter
+
+
+CATALOGUE_PATH = 'medications.json'
+
+# Minimum fraction of the trigrams of a query found in a name for a fuzzy
+# match
+TRIGRAM_THRESHOLD = 0.6
+
+NOT_ALPHANUMERIC = re.compile(r"[^0-9a-z]+")
+
+# Compiled catalogue file: a header with the SHA-256 of the JSON it was
+# built from, a table of sections and the sections, arrays of native
+# unsigned 32-bit integers:
+# - STRING_OFFSETS, STRING_DATA: every distinct string (names,
+#   laboratories and their normalized forms) once, in UTF-8;
+# - NAMES, LABORATORIES, NORMALIZED_LABORATORIES: string of each entry;
+# - SORTED_IDS, SORTED_NAMES: entries sorted by normalized name, and those
+#   normalized names;
+# - TRIGRAM_KEYS, TRIGRAM_OFFSETS, POSTINGS: sorted trigram codes and the
+#   entries containing each one.
+# It is rebuilt when the JSON changes, and memory-mapped, so the workers of
+# a server share the pages of one copy
+ARTIFACT_MAGIC = b"MCAT"
+ARTIFACT_VERSION = 1
+SECTIONS = ("STRING_OFFSETS", "STRING_DATA", "NAMES", "LABORATORIES",
+            "NORMALIZED_LABORATORIES", "SORTED_IDS", "SORTED_NAMES",
+            "TRIGRAM_KEYS", "TRIGRAM_OFFSETS", "POSTINGS")
+HEADER = struct.Struct(f"=4sI32s{2 * len(SECTIONS)}I")
+
+
+def normalize(text: str) -> str:
+    # Lowercase, without accents and with words separated by single spaces:
+    # "ABRAXANE® Liofilizado" -> "abraxane liofilizado"
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return NOT_ALPHANUMERIC.sub(" ", text).strip()
+
+
+def trigrams(text: str, padded: bool = True) -> set[int]:
+    # Names are padded at both ends so their first and last letters are in
+    # trigrams. Queries are only padded at the start, the last word of a
+    # type-ahead query is usually incomplete. Normalized text only has 37
+    # characters, so a trigram is encoded in an integer
+    text = f"  {text} " if padded else f"  {text}"
+    codes = [0 if c == " " else int(c, 36) + 1 for c in text]
+    return {(codes[i] * 37 + codes[i + 1]) * 37 + codes[i + 2] for i in range(len(codes) - 2)}
+
+
+class StringTable:
+    # Read-only sequence of the strings of a catalogue, decoded on access
+
+    def __init__(self, offsets, data, ids=None):
+        self.offsets = offsets
+        self.data = data
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids) if self.ids is not None else len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.ids is not None:
+            i = self.ids[i]
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf8')
+
+
+def build_catalogue(entries: list[dict], source_hash: bytes) -> bytes:
+    strings = {}
+
+    def intern(string):
+        return strings.setdefault(string, len(strings))
+
+    names = array('I', (intern(entry['nombre']) for entry in entries))
+    laboratories = array('I', (intern(entry['laboratorio']) for entry in entries))
+    normalized_laboratories = array('I', (intern(normalize(entry['laboratorio'])) for entry in entries))
+    normalized_names = [normalize(entry['nombre']) for entry in entries]
+    sorted_ids = array('I', sorted(range(len(entries)), key=lambda i: (normalized_names[i], i)))
+    sorted_names = array('I', (intern(normalized_names[i]) for i in sorted_ids))
+
+    trigram_index = {}
+    for i, name in enumerate(normalized_names):
+        for trigram in trigrams(name):
+            trigram_index.setdefault(trigram, []).append(i)
+    trigram_keys = array('I', sorted(trigram_index))
+    trigram_offsets = array('I', [0])
+    postings = array('I')
+    for trigram in trigram_keys:
+        postings.extend(trigram_index[trigram])
+        trigram_offsets.append(len(postings))
+
+    string_data = bytearray()
+    string_offsets = array('I', [0])
+    for string in strings:
+        string_data += string.encode('utf8')
+        string_offsets.append(len(string_data))
+    # Padded so that every section starts at a multiple of 4 bytes
+    string_data += bytes(-len(string_data) % 4)
+
+    sections = [string_offsets.tobytes(), bytes(string_data), names.tobytes(),
+                laboratories.tobytes(), normalized_laboratories.tobytes(),
+                sorted_ids.tobytes(), sorted_names.tobytes(), trigram_keys.tobytes(),
+                trigram_offsets.tobytes(), postings.tobytes()]
+    table = []
+    offset = HEADER.size
+    for section in sections:
+        table += [offset, len(section)]
+        offset += len(section)
+    return HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, source_hash, *table) + b"".join(sections)
+
+
+class Catalogue:
+    # Search index of the medications catalogue over a compiled catalogue
+    # (see build_catalogue):
+    # - names sorted by their normalized form, for prefix searches;
+    # - a trigram index, for fuzzy matches anywhere in the names.
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise ValueError("Not a compiled catalogue")
+        magic, version, self.source_hash, *table = HEADER.unpack_from(view)
+        if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION:
+            raise ValueError("Not a compiled catalogue of this version")
+        sections = {}
+        for name, offset, length in zip(SECTIONS, table[::2], table[1::2]):
+            if offset + length > len(view):
+                raise ValueError("Truncated compiled catalogue")
+            section = view[offset:offset + length]
+            sections[name] = section if name == "STRING_DATA" else section.cast('I')
+        offsets, data = sections["STRING_OFFSETS"], sections["STRING_DATA"]
+        self.names = StringTable(offsets, data, sections["NAMES"])
+        self.laboratories = StringTable(offsets, data, sections["LABORATORIES"])
+        self.normalized_laboratories = StringTable(offsets, data, sections["NORMALIZED_LABORATORIES"])
+        self.sorted_ids = sections["SORTED_IDS"]
+        self.sorted_names = StringTable(offsets, data, sections["SORTED_NAMES"])
+        self.trigram_keys = sections["TRIGRAM_KEYS"]
+        self.trigram_offsets = sections["TRIGRAM_OFFSETS"]
+        self.postings = sections["POSTINGS"]
+
+    def __len__(self):
+        return len(self.names)
+
+    def entry(self, i: int) -> dict:
+        return {"name": self.names[i], "laboratory": self.laboratories[i]}
+
+    def trigram_postings(self, trigram: int):
+        position = bisect.bisect_left(self.trigram_keys, trigram)
+        if position == len(self.trigram_keys) or self.trigram_keys[position] != trigram:
+            return ()
+        return self.postings[self.trigram_offsets[position]:self.trigram_offsets[position + 1]]
+
+    def search(self, q: str, laboratory: str | None = None, limit: int = 10) -> list[dict]:
+        # Names starting with the query first, in alphabetical order, then
+        # names with most of the trigrams of the query, best matches first
+        query = normalize(q)
+        laboratory = normalize(laboratory) if laboratory is not None else None
+        if not query:
+            return []
+
+        def matches_laboratory(i):
+            return laboratory is None or self.normalized_laboratories[i] == laboratory
+
+        results = []
+        position = bisect.bisect_left(self.sorted_names, query)
+        while (len(results) < limit and position < len(self.sorted_names)
+               and self.sorted_names[position].startswith(query)):
+            i = self.sorted_ids[position]
+            if matches_laboratory(i):
+                results.append(i)
+            position += 1
+        if len(results) == limit:
+            return [self.entry(i) for i in results]
+
+        query_trigrams = trigrams(query, padded=False)
+        counts = Counter()
+        for trigram in query_trigrams:
+            counts.update(self.trigram_postings(trigram))
+        minimum = TRIGRAM_THRESHOLD * len(query_trigrams)
+        found = set(results)
+        candidates = [(-count, len(self.names[i]), i) for i, count in counts.items()
+                      if count >= minimum and i not in found and matches_laboratory(i)]
+        candidates.sort()
+        results.extend(i for _, _, i in candidates[:limit - len(results)])
+        return [self.entry(i) for i in results]
+
+
+def artifact_path(path: str) -> str:
+    return f"{os.path.splitext(path)[0]}.catalogue"
+
+
+def map_catalogue(compiled_path: str) -> Catalogue:
+    with open(compiled_path, 'rb') as f:
+        return Catalogue(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def load_catalogue(path: str = CATALOGUE_PATH) -> Catalogue:
+    # Maps the compiled catalogue next to the JSON file, compiling it first
+    # if it is missing or was built from a different JSON
+    with open(path, 'rb') as f:
+        source = f.read()
+    source_hash = hashlib.sha256(source).digest()
+    compiled_path = artifact_path(path)
+    try:
+        catalogue = map_catalogue(compiled_path)
+        if catalogue.source_hash == source_hash:
+            return catalogue
+    except (OSError, ValueError):
+        pass
+
+    compiled = build_catalogue(json.loads(source), source_hash)
+    try:
+        # Written to a temporary file and renamed, so that workers starting
+        # at the same time never map a half-written file
+        directory = os.path.dirname(os.path.abspath(compiled_path))
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            f.write(compiled)
+        os.replace(f.name, compiled_path)
+        return map_catalogue(compiled_path)
+    except OSError:
+        # Read-only directory, the catalogue is kept in memory instead
+        return Catalogue(compiled)
+
+
+@functools.cache
+def get_catalogue() -> Catalogue:
+    # Loaded once per process, on startup (see lifespan in main.py)
+    return load_catalogue()
@@ -1,21 +1,55 @@
 from __future__ import annotations
 
+from sqlalchemy import and_, delete, insert, tuple_, update
 from sqlmodel import Session, select
 from sqlalchemy.exc import IntegrityError
 
-from .models import Patient, Medication, Posology, Intake, MedicationIntake
+from .models import (Patient, Medication, Posology, Intake, MedicationIntake, PatientUpdate, MedicationUpdate,
+                     PosologyUpdate)
+from .cache import (get_cached, invalidate, medication_key, medications_key, patient_key, posologies_key,
+                    set_cached)
+from .analytics import adherence_distribution_statement, cohort_result, lateness_statement, most_missed_statement
+from .versions import bump_versions, find_version, medication_patient_ids
+from .summary import add_expected, add_taken, daily_adherence_statement, remove_summary, reset_expected
+
+
+def paginate(statement, key: tuple, **kwargs):
+    # Keyset pagination: rows sorted by key, after the key of the last row
+    # of the previous page
+    after = kwargs.get('after', None)
+    count = kwargs.get('count', None)
+    if after is not None:
+        statement = statement.where(tuple_(*key) > tuple(after))
+    if count is not None:
+        statement = statement.limit(count)
+    return statement.order_by(*key)
+
+
+def paginate_outerjoin(statement, target, onclause, key: tuple, **kwargs):
+    # Keyset pagination of the rows of target outer joined to a parent row.
+    # The condition of the page goes in the ON clause, so the parent row is
+    # still returned (with NULLs) when the page is empty and an empty list
+    # can be told apart from a missing parent
+    after = kwargs.get('after', None)
+    count = kwargs.get('count', None)
+    if after is not None:
+        onclause = and_(onclause, tuple_(*key) > tuple(after))
+    statement = statement.outerjoin(target, onclause)
+    if count is not None:
+        statement = statement.limit(count)
+    return statement.order_by(*key)
 
 
 def insert_patient(session: Session, patient: Patient) -> Patient | None:
-    statement = select(Patient).where(Patient.code == patient.code)
-    results = session.exec(statement)
-    registered_patient = results.first()
-    if registered_patient is None:
+    # The unique index on Patient.code rejects duplicates atomically
+    try:
         session.add(patient)
+        session.flush()
+        bump_versions(session, [patient.id])
         session.commit()
-        session.refresh(patient)
         return patient
-    else:
+    except IntegrityError:
+        session.rollback()
         return None
 
 
@@ -23,11 +57,16 @@ def find_patient(session: Session, **kwargs) -> Patient | None | list["Patient"]
     patient_id = kwargs.get('patient_id', None)
     code = kwargs.get('code', None)
     start_index = kwargs.get('start_index', None)
-    count = kwargs.get('count', None)
+    version = cached_version(**kwargs)
     if patient_id:
+        patient = get_cached(session, Patient, patient_key(patient_id), version)
+        if patient is not None:
+            return patient
         statement = select(Patient).where(Patient.id == patient_id)
         results = session.exec(statement)
         patient = results.first()
+        if patient is not None:
+            set_cached(session, patient_key(patient_id), patient, version)
         return patient
     if code:
         statement = select(Patient).where(Patient.code == code)
@@ -35,38 +74,83 @@ def find_patient(session: Session, **kwargs) -> Patient | None | list["Patient"]
         patient = results.first()
         return patient
         
-    statement = select(Patient)
+    statement = paginate(select(Patient), (Patient.id,), **kwargs)
     if start_index is not None:
         statement = statement.offset(start_index)
-    if count is not None:
-        statement = statement.limit(count)
     results = session.exec(statement)
     patients = results.all()
     return patients
 
 
-def find_medication(session: Session, patient_id: int, medication_id: int) -> Medication | None:
+def find_patient_version(session: Session, patient_id: int):
+    # (version, updated_at) of the data of the patient, see versions.py
+    return find_version(session, patient_id)
+
+
+def cached_version(**kwargs) -> int | None:
+    # The version kwarg of the find_* functions that cache their results:
+    # the result of find_patient_version, read by a caller that sends it
+    # with the data
+    version = kwargs.get('version', None)
+    return version.version if version is not None else None
+
+
+def has_patients(session: Session) -> bool:
+    # Reads at most one row, whatever the size of the table
+    statement = select(Patient.id).limit(1)
+    return session.exec(statement).first() is not None
+
+
+def find_medication(session: Session, patient_id: int, medication_id: int, **kwargs) -> Medication | None:
+    version = cached_version(**kwargs)
+    medication = get_cached(session, Medication, medication_key(patient_id, medication_id), version)
+    if medication is not None:
+        return medication
     statement = select(Medication).where(
         Medication.patient_id == patient_id,
         Medication.id == medication_id)
     results = session.exec(statement)
     medication = results.first()
+    if medication is not None:
+        set_cached(session, medication_key(patient_id, medication_id), medication, version)
     return medication
 
 
-def find_medications(session: Session, patient_id: int) -> list["Medication"]:
-    statement = select(Medication).where(
-        (Medication.patient_id == patient_id))
+def find_medication_ids(session: Session, patient_id: int) -> set[int]:
+    statement = select(Medication.id).where(
+        Medication.patient_id == patient_id)
+    results = session.exec(statement)
+    return set(results.all())
+
+
+def find_medications(session: Session, patient_id: int, **kwargs) -> list["Medication"] | None:
+    # None if the patient does not exist, found by the same query as the
+    # medications. Only the whole list is cached, not its pages
+    whole = kwargs.get('after', None) is None and kwargs.get('count', None) is None
+    version = cached_version(**kwargs)
+    if whole:
+        medications = get_cached(session, Medication, medications_key(patient_id), version)
+        if medications is not None:
+            return medications
+    statement = select(Patient.id, Medication).select_from(Patient).where(
+        Patient.id == patient_id)
+    statement = paginate_outerjoin(
+        statement, Medication, Medication.patient_id == Patient.id, (Medication.id,), **kwargs)
     results = session.exec(statement)
-    medications = results.all()
+    rows = results.all()
+    if len(rows) == 0:
+        return None
+    medications = [medication for _, medication in rows if medication is not None]
+    if whole:
+        set_cached(session, medications_key(patient_id), medications, version)
     return medications
 
 
 def find_posology(session: Session, patient_id: int, medication_id: int, posology_id: int) -> Posology | None:
-    statement = select(Medication, Posology).where(
+    statement = select(Medication, Posology).join(
+        Posology, Posology.medication_id == Medication.id).where(
         Medication.patient_id == patient_id,
         Medication.id == medication_id,
-        Posology.medication_id == medication_id,
         Posology.id == posology_id)
     results = session.exec(statement)
     data = results.first()
@@ -76,103 +160,229 @@ def find_posology(session: Session, patient_id: int, medication_id: int, posolog
     return None
 
 
-def find_posologies(session: Session, patient_id: int, medication_id: int) -> list["Posology"]:
-    statement = select(Medication, Posology).where(
+def find_posologies(session: Session, patient_id: int, medication_id: int, **kwargs) -> list["Posology"] | None:
+    # None if the medication is not one of the patient, found by the same
+    # query as the posologies. Only the whole list is cached, not its pages
+    whole = kwargs.get('after', None) is None and kwargs.get('count', None) is None
+    version = cached_version(**kwargs)
+    if whole:
+        posologies = get_cached(session, Posology, posologies_key(patient_id, medication_id), version)
+        if posologies is not None:
+            return posologies
+    statement = select(Medication.id, Posology).select_from(Medication).where(
         Medication.patient_id == patient_id,
-        Medication.id == medication_id,
-        Posology.medication_id == medication_id)
+        Medication.id == medication_id)
+    statement = paginate_outerjoin(
+        statement, Posology, Posology.medication_id == Medication.id, (Posology.id,), **kwargs)
     results = session.exec(statement)
-    posologies = []
-    for _, posology in results.all():
-        posologies.append(posology)
+    rows = results.all()
+    if len(rows) == 0:
+        return None
+    posologies = [posology for _, posology in rows if posology is not None]
+    if whole:
+        set_cached(session, posologies_key(patient_id, medication_id), posologies, version)
     return posologies
 
 
 def insert_medication(session: Session, medication: Medication) -> Medication | None:
     try:
+        patient_id = medication.patient_id
         session.add(medication)
+        bump_versions(session, [patient_id])
         session.commit()
-        session.refresh(medication)
+        invalidate(session, medications_key(patient_id))
         return medication
     except IntegrityError:
+        session.rollback()
         return None
 
 
-def insert_posology(session: Session, posology: Posology) -> Posology | None:
+def posology_keys(medication: Medication | None) -> list[str]:
+    # Cache entries changed by a write of a posology of the medication
+    if medication is None:
+        return []
+    return [posologies_key(medication.patient_id, medication.id)]
+
+
+def insert_posology(session: Session, posology: Posology, **kwargs) -> Posology | None:
+    # With patient_id, None if the medication is not one of the patient
+    patient_id = kwargs.get('patient_id', None)
     try:
+        medication = session.get(Medication, posology.medication_id)
+        if medication is None or (patient_id is not None and medication.patient_id != patient_id):
+            return None
         session.add(posology)
+        add_expected(session, medication, 1)
+        bump_versions(session, [medication.patient_id])
+        keys = posology_keys(medication)
         session.commit()
-        session.refresh(posology)
+        invalidate(session, *keys)
         return posology
     except IntegrityError:
+        session.rollback()
         return None
 
-def update_posology_data(session: Session, posology: Posology) -> bool:
-    try:
-        session.add(posology)
+
+def update_row(session: Session, model, values: dict, conditions: list, returning: tuple):
+    # A single UPDATE of the columns in values of the row that matches the
+    # conditions, which returns the columns in returning of the row, or None
+    # if no row matches. Without values the row is only read
+    if len(values) == 0:
+        statement = select(*returning).where(*conditions)
+    else:
+        statement = update(model).where(*conditions).values(**values).returning(
+            *returning).execution_options(synchronize_session=False)
+    return session.execute(statement).first()
+
+
+def update_posology_data(session: Session, patient_id: int, medication_id: int, posology_id: int,
+                         posology: PosologyUpdate) -> bool:
+    # False if the posology is not one of the medication of the patient
+    values = posology.model_dump(exclude_unset=True)
+    row = update_row(session, Posology, values, [
+        Posology.id == posology_id,
+        Posology.medication_id == medication_id,
+        Posology.medication_id.in_(select(Medication.id).where(
+            Medication.id == medication_id,
+            Medication.patient_id == patient_id))], (Posology.id,))
+    if row is None:
+        session.rollback()
+        return False
+    if values:
+        bump_versions(session, [patient_id])
         session.commit()
-        session.refresh(posology)
-        return True
-    except IntegrityError:
+        invalidate(session, posologies_key(patient_id, medication_id))
+    return True
+
+def remove_children(session: Session, medications):
+    # Intakes, posologies and summary rows of the medications selected by
+    # the subquery, with one DELETE per table whatever their number. The
+    # deleted rows are not loaded into the session
+    remove_summary(session, medications)
+    for model in (Intake, Posology):
+        session.execute(
+            delete(model).where(model.medication_id.in_(medications)).execution_options(
+                synchronize_session=False))
+
+
+def remove_patient(session: Session, patient_id: int) -> bool:
+    # False if the patient does not exist
+    medication_ids = find_medication_ids(session, patient_id)
+    remove_children(session, select(Medication.id).where(Medication.patient_id == patient_id))
+    session.execute(delete(Medication).where(Medication.patient_id == patient_id).execution_options(
+        synchronize_session=False))
+    result = session.execute(delete(Patient).where(Patient.id == patient_id).execution_options(
+        synchronize_session=False))
+    if result.rowcount == 0:
+        session.rollback()
         return False
-
-def remove_patient(session: Session, patient: Patient):
-    session.delete(patient)
+    bump_versions(session, [patient_id])
     session.commit()
+    invalidate(session, patient_key(patient_id), medications_key(patient_id),
+               *(medication_key(patient_id, medication_id) for medication_id in medication_ids),
+               *(posologies_key(patient_id, medication_id) for medication_id in medication_ids))
+    return True
 
 
-def remove_medication(session: Session, medication: Medication):
-    session.delete(medication)
+def remove_medication(session: Session, patient_id: int, medication_id: int) -> bool:
+    # False if the medication is not one of the patient
+    medication = select(Medication.id).where(
+        Medication.id == medication_id,
+        Medication.patient_id == patient_id)
+    remove_children(session, medication)
+    result = session.execute(delete(Medication).where(
+        Medication.id == medication_id,
+        Medication.patient_id == patient_id).execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        session.rollback()
+        return False
+    bump_versions(session, [patient_id])
     session.commit()
+    invalidate(session, medications_key(patient_id), medication_key(patient_id, medication_id),
+               posologies_key(patient_id, medication_id))
+    return True
 
 
 def remove_posology(session: Session, posology: Posology):
+    medication = session.get(Medication, posology.medication_id)
+    if medication is not None:
+        add_expected(session, medication, -1)
+        bump_versions(session, [medication.patient_id])
+    keys = posology_keys(medication)
     session.delete(posology)
     session.commit()
+    invalidate(session, *keys)
 
 
-def update_patient_data(session: Session, new_patient: Patient) -> bool:
-    patient = find_patient(session, patient_id=new_patient.id)
-    if patient is not None:
-        patient.name = new_patient.name
-        patient.surname = new_patient.surname
-        patient.code = new_patient.code
-        session.add(patient)
-        session.commit()
-        session.refresh(patient)
+def update_patient_data(session: Session, patient_id: int, patient: PatientUpdate) -> bool:
+    # False if the patient does not exist or the new code is already used
+    values = patient.model_dump(exclude_unset=True)
+    try:
+        row = update_row(session, Patient, values, [Patient.id == patient_id], (Patient.id,))
+        if row is None:
+            session.rollback()
+            return False
+        if values:
+            bump_versions(session, [patient_id])
+            session.commit()
+            invalidate(session, patient_key(patient_id))
         return True
+    except IntegrityError:
+        session.rollback()
     return False
 
 
-def update_medication_data(session: Session, new_medication: Medication) -> bool:
-    medication = find_medication(
-        session, new_medication.patient_id, new_medication.id)
-    if medication is not None:
-        medication.name = new_medication.name
-        medication.dosage = new_medication.dosage
-        medication.start_date = new_medication.start_date
-        medication.treatment_duration = new_medication.treatment_duration
-        session.add(medication)
+def update_medication_data(session: Session, patient_id: int, medication_id: int,
+                           medication: MedicationUpdate) -> bool:
+    # False if the medication is not one of the patient
+    values = medication.model_dump(exclude_unset=True)
+    row = update_row(session, Medication, values, [
+        Medication.id == medication_id,
+        Medication.patient_id == patient_id], (Medication.start_date, Medication.treatment_duration))
+    if row is None:
+        session.rollback()
+        return False
+    if values:
+        if 'start_date' in values or 'treatment_duration' in values:
+            # The days of the treatment changed
+            reset_expected(session, Medication(
+                id=medication_id, start_date=row.start_date, treatment_duration=row.treatment_duration))
+        bump_versions(session, [patient_id])
         session.commit()
-        session.refresh(medication)
-        return True
-    return False
+        invalidate(session, medication_key(patient_id, medication_id), medications_key(patient_id))
+    return True
 
 
 def insert_intake(session: Session, intake: Intake) -> Intake:
     session.add(intake)
+    add_taken(session, [(intake.medication_id, intake.date)], 1)
+    bump_versions(session, medication_patient_ids(session, [intake.medication_id]))
     session.commit()
-    session.refresh(intake)
     return intake
 
 
-def find_intake(session: Session, patient_id: int, medication_id: int, intake_id: int) -> Intake | None:
+def insert_intakes(session: Session, intakes: list["Intake"]) -> list[int]:
+    # One multi-row INSERT in a single transaction. The ids are returned in
+    # the same order as the intakes
+    if len(intakes) == 0:
+        return []
+    statement = insert(Intake).returning(
+        Intake.id, sort_by_parameter_order=True)
+    results = session.scalars(statement, [
+        {"medication_id": intake.medication_id, "date": intake.date} for intake in intakes])
+    intake_ids = results.all()
+    add_taken(session, [(intake.medication_id, intake.date) for intake in intakes], 1)
+    bump_versions(session, medication_patient_ids(session, [intake.medication_id for intake in intakes]))
+    session.commit()
+    return intake_ids
+
 
-    statement = select(Medication, Intake).where(
+def find_intake(session: Session, patient_id: int, medication_id: int, intake_id: int) -> Intake | None:
+    statement = select(Medication, Intake).join(
+        Intake, Intake.medication_id == Medication.id).where(
         Medication.id == medication_id,
         Medication.patient_id == patient_id,
-        Intake.id == intake_id,
-        Intake.medication_id == medication_id)
+        Intake.id == intake_id)
     result = session.exec(statement)
     data = result.first()
     if data is not None:
@@ -181,59 +391,124 @@ def find_intake(session: Session, patient_id: int, medication_id: int, intake_id
     return None
 
 
-def find_intakes(session: Session, medication_id: int, **kwargs) -> list["Intake"]:
+def find_intakes(session: Session, medication_id: int, **kwargs) -> list["Intake"] | None:
+    # With patient_id, None if the medication is not one of the patient,
+    # found by the same query as the intakes
+    patient_id = kwargs.get('patient_id', None)
     start_date = kwargs.get('start_date', None)
     end_date = kwargs.get('end_date', None)
-    if start_date is not None and end_date is not None:
+    conditions = []
+    if start_date is not None:
+        conditions.append(Intake.date >= start_date)
+    if end_date is not None:
+        conditions.append(Intake.date <= end_date)
+    if patient_id is None:
         statement = select(Intake).where(
-            Intake.medication_id == medication_id,
-            Intake.date >= start_date,
-            Intake.date <= end_date)
-    elif start_date is not None:
-        statement = select(Intake).where(
-            Intake.medication_id == medication_id,
-            Intake.date >= start_date)
-    elif end_date is not None:
-        statement = select(Intake).where(
-            Intake.medication_id == medication_id,
-            Intake.date <= end_date)
-    else:
-        statement = select(Intake).where(
-            Intake.medication_id == medication_id)
+            Intake.medication_id == medication_id, *conditions)
+        statement = paginate(statement, (Intake.date, Intake.id), **kwargs)
+        results = session.exec(statement)
+        intakes = results.all()
+        return intakes
+
+    statement = select(Medication.id, Intake).select_from(Medication).where(
+        Medication.patient_id == patient_id,
+        Medication.id == medication_id)
+    statement = paginate_outerjoin(
+        statement, Intake, and_(Intake.medication_id == Medication.id, *conditions), (Intake.date, Intake.id),
+        **kwargs)
     results = session.exec(statement)
-    intakes = results.all()
-    return intakes
+    rows = results.all()
+    if len(rows) == 0:
+        return None
+    return [intake for _, intake in rows if intake is not None]
 
 
-def find_intakes_by_patient(session: Session, patient_id: int, **kwargs) -> list["MedicationIntake"]:
+def find_intake_dates(session: Session, patient_id: int, **kwargs) -> list[tuple[int, str]]:
+    # (medication_id, date) of the intakes of a patient, or of one of its
+    # medications, sorted by medication and date
+    medication_id = kwargs.get('medication_id', None)
     start_date = kwargs.get('start_date', None)
     end_date = kwargs.get('end_date', None)
+    statement = select(Intake.medication_id, Intake.date).where(
+        Medication.id == Intake.medication_id,
+        Medication.patient_id == patient_id)
+    if medication_id is not None:
+        statement = statement.where(Intake.medication_id == medication_id)
+    if start_date is not None:
+        statement = statement.where(Intake.date >= start_date)
+    if end_date is not None:
+        statement = statement.where(Intake.date <= end_date)
+    statement = statement.order_by(Intake.medication_id, Intake.date)
+    results = session.exec(statement)
+    return results.all()
+
+
+def find_medications_with_posologies(session: Session, patient_id: int) -> list[tuple["Medication", list["Posology"]]] | None:
+    # Medications and posologies of the patient in a single query, so the
+    # number of round trips does not depend on the number of medications.
+    # None if the patient does not exist
+    statement = select(Patient.id, Medication, Posology).select_from(Patient).outerjoin(
+        Medication, Medication.patient_id == Patient.id).outerjoin(
+        Posology, Posology.medication_id == Medication.id).where(
+        Patient.id == patient_id).order_by(Medication.id, Posology.id)
+    rows = session.exec(statement).all()
+    if len(rows) == 0:
+        return None
+    medications = dict()
+    for _, medication, posology in rows:
+        if medication is None:
+            continue
+        posologies = medications.setdefault(medication.id, (medication, []))[1]
+        if posology is not None:
+            posologies.append(posology)
+    return list(medications.values())
+
+
+def find_intakes_by_patient(session: Session, patient_id: int, **kwargs) -> list["MedicationIntake"] | None:
+    # None if the patient does not exist
+    start_date = kwargs.get('start_date', None)
+    end_date = kwargs.get('end_date', None)
+
+    medications_with_posologies = find_medications_with_posologies(session, patient_id)
+    if medications_with_posologies is None:
+        return None
+    medications = dict()
+    posologies_by_medication = dict()
+    for medication, posologies in medications_with_posologies:
+        medications[medication.id] = medication
+        posologies_by_medication[medication.id] = posologies
 
     if start_date is not None and end_date is not None:
-        statement = select(Medication, Intake).where(
+        statement = select(Intake).where(
             Medication.patient_id == patient_id,
             Medication.id == Intake.medication_id,
             Intake.date >= start_date,
             Intake.date <= end_date)
     elif start_date is not None:
-        statement = select(Medication, Intake).where(
+        statement = select(Intake).where(
             Medication.patient_id == patient_id,
             Medication.id == Intake.medication_id,
             Intake.date >= start_date)
     elif end_date is not None:
-        statement = select(Medication, Intake).where(
+        statement = select(Intake).where(
             Medication.patient_id == patient_id,
             Medication.id == Intake.medication_id,
             Intake.date <= end_date)
     else:
-        statement = select(Medication, Intake).where(
+        statement = select(Intake).where(
             Medication.patient_id == patient_id,
             Medication.id == Intake.medication_id,
         )
+    statement = paginate(
+        statement, (Intake.medication_id, Intake.date, Intake.id), **kwargs)
     results = session.exec(statement)
-    medication_and_intakes = results.all()
+
     intakes_by_medication = dict()
-    for medication, intake in medication_and_intakes:
+    for intake in results:
+        medication = medications.get(intake.medication_id, None)
+        if medication is None:
+            # Medication added after the first query
+            continue
         if medication.id not in intakes_by_medication:
             intakes_by_medication[medication.id] = MedicationIntake(
                 id=medication.id,
@@ -241,15 +516,56 @@ def find_intakes_by_patient(session: Session, patient_id: int, **kwargs) -> list
                 dosage=medication.dosage,
                 start_date=medication.start_date,
                 treatment_duration=medication.treatment_duration,
-                posologies_by_medication=find_posologies(session, patient_id, medication.id),
+                posologies_by_medication=posologies_by_medication[medication.id],
                 patient_id=medication.patient_id)
-            
+
         intakes_by_medication[medication.id].intakes_by_medication.append(
             intake)
 
     return list(intakes_by_medication.values())
 
 
+def find_daily_adherence(session: Session, **kwargs) -> list[tuple[int, int, int]]:
+    # (day, expected, taken) from the daily adherence summary
+    results = session.exec(daily_adherence_statement(**kwargs))
+    return results.all()
+
+
+def find_cohort_analytics(session: Session, **kwargs) -> dict:
+    # Accepts start_date, end_date, tolerance and limit
+    dialect = session.get_bind().dialect.name
+    distribution = session.exec(adherence_distribution_statement(**kwargs)).all()
+    most_missed = session.exec(most_missed_statement(**kwargs)).all()
+    lateness = session.exec(lateness_statement(dialect, **kwargs)).all()
+    return cohort_result(distribution, most_missed, lateness)
+
+
+def intakes_export_statement(**kwargs):
+    patient_id = kwargs.get('patient_id', None)
+    start_date = kwargs.get('start_date', None)
+    end_date = kwargs.get('end_date', None)
+    statement = select(Medication.patient_id, Intake.medication_id, Medication.name, Intake.id, Intake.date).where(
+        Medication.id == Intake.medication_id)
+    if patient_id is not None:
+        statement = statement.where(Medication.patient_id == patient_id)
+    if start_date is not None:
+        statement = statement.where(Intake.date >= start_date)
+    if end_date is not None:
+        statement = statement.where(Intake.date <= end_date)
+    return statement.order_by(Intake.medication_id, Intake.date, Intake.id)
+
+
+def iter_intakes_export(session: Session, batch_size: int, **kwargs):
+    # Rows are fetched batch_size at a time (server-side cursor where the
+    # database supports it) so memory does not grow with the history size
+    statement = intakes_export_statement(**kwargs)
+    results = session.exec(statement.execution_options(yield_per=batch_size))
+    for rows in results.partitions():
+        yield rows
+
+
 def remove_intake(session: Session, intake: Intake):
+    add_taken(session, [(intake.medication_id, intake.date)], -1)
+    bump_versions(session, medication_patient_ids(session, [intake.medication_id]))
     session.delete(intake)
     session.commit()
@@ -0,0 +1,197 @@
+import argparse
+import datetime
+import os
+import re
+
+from sqlalchemy import Integer, text
+from sqlalchemy.types import TypeDecorator
+from sqlmodel.sql.sqltypes import AutoString
+
+
+DATE_FORMAT = "%Y-%m-%d"
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M"
+EPOCH = datetime.datetime(1970, 1, 1)
+MINUTE = datetime.timedelta(minutes=1)
+DAY = datetime.timedelta(days=1)
+
+# How Medication.start_date and Intake.date are stored:
+# - text: the API strings as they are
+# - integer: days (start_date) and minutes (date) since 1970-01-01
+# The API format does not change. Existing databases are converted with
+# python -m sql_app.dates
+DATE_STORAGE = os.environ.get("MEDICATIONS_DATE_STORAGE", "text")
+if DATE_STORAGE not in ("text", "integer"):
+    raise ValueError(
+        f"Unknown MEDICATIONS_DATE_STORAGE {DATE_STORAGE}. Available modes: text, integer")
+
+
+class EpochDays(TypeDecorator):
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        date = datetime.datetime.strptime(value, DATE_FORMAT)
+        return (date - EPOCH) // DAY
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return (EPOCH + value * DAY).strftime(DATE_FORMAT)
+
+
+class EpochMinutes(TypeDecorator):
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        date = datetime.datetime.strptime(value, DATETIME_FORMAT)
+        return (date - EPOCH) // MINUTE
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return (EPOCH + value * MINUTE).strftime(DATETIME_FORMAT)
+
+
+if DATE_STORAGE == "integer":
+    DATE_TYPE = EpochDays
+    DATETIME_TYPE = EpochMinutes
+else:
+    DATE_TYPE = AutoString
+    DATETIME_TYPE = AutoString
+
+
+# SQL expressions converting the text columns to the integer representation
+CONVERSIONS = {
+    "sqlite": {
+        "days": "CAST(strftime('%s', {column}) AS INTEGER) / 86400",
+        "minutes": "CAST(strftime('%s', {column}) AS INTEGER) / 60",
+    },
+    "postgresql": {
+        "days": "CAST({column} AS DATE) - DATE '1970-01-01'",
+        "minutes": "CAST(EXTRACT(EPOCH FROM CAST({column} AS TIMESTAMP)) / 60 AS INTEGER)",
+    },
+}
+
+CONVERTED_COLUMNS = (
+    ("medication", "start_date", "days", None),
+    ("intake", "date", "minutes", ("ix_intake_medication_id_date", "medication_id, date")),
+)
+
+
+def is_converted(connection, table: str, column: str) -> bool:
+    # Whether the column holds integer dates already. Converting it again
+    # would read the integers as other dates: SQLite takes them for Julian
+    # day numbers
+    if connection.dialect.name == "postgresql":
+        column_type = connection.execute(text(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = :column"),
+            {"table": table, "column": column}).scalar()
+        return column_type in ("integer", "bigint", "smallint")
+    column_type = next(row[2] for row in connection.execute(text(f"PRAGMA table_info({table})")) if row[1] == column)
+    return "INT" in column_type.upper()
+
+
+def rebuild_sqlite_table(connection, table: str, column: str, conversion: str):
+    # SQLite cannot change the type of a column: the table is created again
+    # with the column as INTEGER, following the procedure of
+    # https://www.sqlite.org/lang_altertable.html#otheralter, so that it
+    # keeps its constraints and indexes
+    table_sql = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :table"), {"table": table}).scalar()
+    other_sql = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = :table "
+        "AND sql IS NOT NULL"), {"table": table}).scalars().all()
+    new_sql = re.sub(rf'^CREATE TABLE "?{table}"?', f"CREATE TABLE {table}_new", table_sql)
+    new_sql, replaced = re.subn(rf'([(,]\s*"?{column}"?\s+)\w+(\(\d+\))?', r"\1INTEGER", new_sql, count=1)
+    if replaced != 1:
+        raise ValueError(f"Column {column} not found in the table {table}")
+    invalid = connection.execute(text(
+        f"SELECT COUNT(*) FROM {table} WHERE {column} IS NOT NULL "
+        f"AND ({conversion} IS NULL OR {column} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*')")).scalar()
+    if invalid:
+        raise ValueError(
+            f"{invalid} rows of {table} have an invalid {column}")
+    columns = [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))]
+    values = [f"{conversion} AS {name}" if name == column else name for name in columns]
+    connection.execute(text(new_sql))
+    connection.execute(text(
+        f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}"))
+    connection.execute(text(f"DROP TABLE {table}"))
+    connection.execute(text(f"ALTER TABLE {table}_new RENAME TO {table}"))
+    for sql in other_sql:
+        connection.execute(text(sql))
+
+
+def convert_sqlite_dates(engine) -> list[str]:
+    converted = []
+    with engine.connect() as connection:
+        # Foreign keys cannot be disabled inside a transaction, and tables
+        # referenced by others are dropped while rebuilt
+        foreign_keys = connection.execute(text("PRAGMA foreign_keys")).scalar()
+        connection.execute(text("PRAGMA foreign_keys = OFF"))
+        try:
+            # The DDL statements are part of the transaction too, the driver
+            # only begins one before DML statements
+            connection.execute(text("BEGIN"))
+            for table, column, unit, _ in CONVERTED_COLUMNS:
+                if is_converted(connection, table, column):
+                    continue
+                rebuild_sqlite_table(connection, table, column, CONVERSIONS["sqlite"][unit].format(column=column))
+                converted.append(f"{table}.{column}")
+            if foreign_keys and connection.execute(text("PRAGMA foreign_key_check")).first() is not None:
+                raise ValueError("The converted tables have rows with invalid foreign keys")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.execute(text(f"PRAGMA foreign_keys = {foreign_keys}"))
+            connection.commit()
+    return converted
+
+
+def convert_dates(engine) -> list[str]:
+    # Converts a database created with the text storage to the integer
+    # storage, in a single transaction. Columns converted already are
+    # skipped, returns the ones converted
+    dialect = engine.dialect.name
+    if dialect not in CONVERSIONS:
+        raise ValueError(f"Date conversion is not supported in {dialect}")
+    if dialect == "sqlite":
+        return convert_sqlite_dates(engine)
+    converted = []
+    with engine.begin() as connection:
+        for table, column, unit, index in CONVERTED_COLUMNS:
+            if is_converted(connection, table, column):
+                continue
+            converted.append(f"{table}.{column}")
+            conversion = CONVERSIONS[dialect][unit].format(column=column)
+            if index is not None:
+                connection.execute(text(f"DROP INDEX IF EXISTS {index[0]}"))
+            connection.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE INTEGER USING {conversion}"))
+            if index is not None:
+                connection.execute(text(
+                    f"CREATE INDEX {index[0]} ON {table} ({index[1]})"))
+    return converted
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+    from .database import DB_URL
+
+    parser = argparse.ArgumentParser(
+        description="Convert the dates of a database from text to integer storage")
+    parser.add_argument("--url", default=DB_URL,
+                        help="Database URL (default: MEDICATIONS_DB_URL or the local SQLite file)")
+    args = parser.parse_args()
+    converted = convert_dates(create_engine(args.url))
+    if converted:
+        print(f"Dates of {', '.join(converted)} converted. Run the server with MEDICATIONS_DATE_STORAGE=integer")
+    else:
+        print("Dates converted already. Run the server with MEDICATIONS_DATE_STORAGE=integer")
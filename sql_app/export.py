@@ -0,0 +1,30 @@
+import csv
+import io
+import json
+
+
+EXPORT_COLUMNS = ("patient_id", "medication_id", "medication_name", "intake_id", "date")
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Rows fetched from the database and written to the response at a time
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_header(export_format: str, columns: tuple = EXPORT_COLUMNS) -> str:
+    if export_format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(columns)
+        return buffer.getvalue()
+    return ""
+
+
+def export_rows(rows, export_format: str, columns: tuple = EXPORT_COLUMNS) -> str:
+    if export_format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
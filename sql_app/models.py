@@ -1,44 +1,89 @@
 
 from typing import Optional
+from sqlalchemy import BigInteger, Index, Integer
 from sqlmodel import Field, Relationship, SQLModel
 from pydantic import BaseModel
 
+from .dates import DATE_TYPE, DATETIME_TYPE
+
+# BIGINT keys where supported. SQLite keeps INTEGER, so the primary keys
+# remain aliases of the rowid and autoincrement
+ID_TYPE = BigInteger().with_variant(Integer, "sqlite")
+
+
 class Message(BaseModel):
     detail: str
 
 class Patient(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
-    code: str
+    id: Optional[int] = Field(default=None, primary_key=True, sa_type=ID_TYPE)
+    code: str = Field(unique=True, index=True)
     name: Optional[str]  = None
     surname: Optional[str] = None
     medications: list["Medication"] = Relationship(back_populates="patient", sa_relationship_kwargs={"cascade": "delete"})
 
 class Medication(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    __table_args__ = (Index("ix_medication_patient_id_id", "patient_id", "id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True, sa_type=ID_TYPE)
     name: str
     dosage: float = Field(default=1.0)
-    start_date: str
+    start_date: str = Field(sa_type=DATE_TYPE)
     treatment_duration: int = Field(default=1)
-    patient_id: int = Field(foreign_key="patient.id")
+    patient_id: int = Field(foreign_key="patient.id", sa_type=ID_TYPE)
     patient: Patient = Relationship(back_populates="medications")
     posology: list["Posology"] = Relationship(back_populates="medication_posology", sa_relationship_kwargs={"cascade": "delete"})
     intakes: list["Intake"] = Relationship(back_populates="medication_intake", sa_relationship_kwargs={"cascade": "delete"})
 
  
 class Posology(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_type=ID_TYPE)
     hour: int
     minute: int
-    medication_id: int = Field(foreign_key="medication.id")
+    medication_id: int = Field(foreign_key="medication.id", index=True, sa_type=ID_TYPE)
     medication_posology: Medication = Relationship(back_populates="posology")
 
 
 class Intake(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
-    date: str
-    medication_id: int = Field(foreign_key="medication.id")
+    __table_args__ = (Index("ix_intake_medication_id_date", "medication_id", "date"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True, sa_type=ID_TYPE)
+    date: str = Field(sa_type=DATETIME_TYPE)
+    medication_id: int = Field(foreign_key="medication.id", sa_type=ID_TYPE)
     medication_intake: Medication = Relationship(back_populates="intakes")
 
+class DailyAdherence(SQLModel, table=True):
+    # Expected doses and intakes of a medication in a day (days since
+    # 1970-01-01), maintained by crud.py. See sql_app/summary.py
+    __table_args__ = (Index("ix_dailyadherence_day", "day"),)
+
+    medication_id: int = Field(foreign_key="medication.id", primary_key=True, sa_type=ID_TYPE)
+    day: int = Field(primary_key=True)
+    expected: int = Field(default=0)
+    taken: int = Field(default=0)
+
+class PatientVersion(SQLModel, table=True):
+    # Version of the data of a patient and time of its last change, in
+    # seconds since 1970-01-01. See sql_app/versions.py
+    patient_id: int = Field(primary_key=True, sa_type=ID_TYPE, sa_column_kwargs={"autoincrement": False})
+    version: int = Field(default=0)
+    updated_at: int = Field(default=0)
+
+class PatientUpdate(BaseModel):
+    # Body of a PATCH, only the fields sent are changed
+    code: str = None
+    name: Optional[str] = None
+    surname: Optional[str] = None
+
+class MedicationUpdate(BaseModel):
+    name: str = None
+    dosage: float = None
+    start_date: str = None
+    treatment_duration: int = None
+
+class PosologyUpdate(BaseModel):
+    hour: int = None
+    minute: int = None
+
 class MedicationIntake(BaseModel):
     id: int
     name: str
@@ -47,4 +92,73 @@ class MedicationIntake(BaseModel):
     treatment_duration: int
     patient_id: int
     posologies_by_medication: Optional[list["Posology"]] = []
-    intakes_by_medication: Optional[list["Intake"]] = []
\ No newline at end of file
+    intakes_by_medication: Optional[list["Intake"]] = []
+
+class IntakeBatchItem(BaseModel):
+    medication_id: int
+    date: str
+
+class IntakeBatchResult(BaseModel):
+    status: int
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+class CatalogueEntry(BaseModel):
+    name: str
+    laboratory: str
+
+class Adherence(BaseModel):
+    medication_id: Optional[int] = None
+    expected: int
+    taken: int
+    late: int
+    missed: int
+    extra: int
+    taken_percentage: float
+    late_percentage: float
+    missed_percentage: float
+
+class PatientAdherence(BaseModel):
+    patient_id: int
+    total: Adherence
+    medications: list[Adherence] = []
+
+class DailyAdherenceSummary(BaseModel):
+    date: str
+    expected: int
+    taken: int
+    taken_percentage: float
+
+class AdherenceBucket(BaseModel):
+    min_percentage: int
+    max_percentage: int
+    patients: int
+
+class MissedMedication(BaseModel):
+    name: str
+    expected: int
+    missed: int
+    missed_percentage: float
+
+class LatenessBucket(BaseModel):
+    hour: int
+    delay: int
+    intakes: int
+
+class CohortAnalytics(BaseModel):
+    patients: int
+    adherence_distribution: list[AdherenceBucket]
+    most_missed: list[MissedMedication]
+    lateness: list[LatenessBucket]
+
+class CacheMetrics(BaseModel):
+    backend: str
+    size: Optional[int] = None
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+class CacheStats(BaseModel):
+    reads: CacheMetrics
+    analytics: CacheMetrics
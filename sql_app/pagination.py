@@ -0,0 +1,43 @@
+import base64
+import datetime
+import json
+
+from .dates import DATETIME_FORMAT
+
+
+# Response header with the cursor of the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def datetime_key(value: str) -> str:
+    datetime.datetime.strptime(value, DATETIME_FORMAT)
+    return value
+
+
+def encode_cursor(key: tuple) -> str:
+    data = json.dumps(list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, converters: tuple) -> tuple:
+    # A cursor is the sort key of the last row of the previous page. Each
+    # value is checked with its converter (int, datetime_key...)
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(data)
+        if not isinstance(key, list) or len(key) != len(converters):
+            raise ValueError
+        return tuple(convert(value) for convert, value in zip(converters, key))
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor {cursor}")
+
+
+def next_cursor(rows: list, count: int | None, key) -> str | None:
+    # Only full pages can be followed by another page
+    if count is None or len(rows) == 0 or len(rows) < count:
+        return None
+    return encode_cursor(key(rows[-1]))
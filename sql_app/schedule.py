@@ -0,0 +1,59 @@
+import datetime
+import heapq
+import itertools
+
+from .dates import DATE_FORMAT, DATETIME_FORMAT, EPOCH, DAY, MINUTE
+from .models import Medication, Posology
+
+
+SCHEDULE_COLUMNS = ("medication_id", "medication_name", "posology_id", "date")
+
+MINUTES_PER_DAY = 1440
+
+# Doses written to the response at a time
+SCHEDULE_BATCH_SIZE = 1000
+
+
+def to_minutes(date: str, date_format: str = DATETIME_FORMAT) -> int:
+    return (datetime.datetime.strptime(date, date_format) - EPOCH) // MINUTE
+
+
+def from_minutes(minutes: int) -> str:
+    return (EPOCH + minutes * MINUTE).strftime(DATETIME_FORMAT)
+
+
+def posology_doses(medication: Medication, posology: Posology, start: int, end: int) -> range:
+    # Minutes since 1970-01-01 of the doses of a posology between start and
+    # end (both included), one a day during the treatment
+    first = to_minutes(medication.start_date, DATE_FORMAT) + posology.hour * 60 + posology.minute
+    last = first + (medication.treatment_duration - 1) * MINUTES_PER_DAY
+    if first < start:
+        first += -(-(start - first) // MINUTES_PER_DAY) * MINUTES_PER_DAY
+    return range(first, min(last, end) + 1, MINUTES_PER_DAY)
+
+
+def expand_schedule(medications: list[tuple["Medication", list["Posology"]]], start: int, end: int):
+    # Doses of all the posologies between start and end, as
+    # SCHEDULE_COLUMNS rows sorted by date. Each posology is a lazy range
+    # and the ranges are merged with a heap, so memory does not depend on
+    # the length of the period
+    def doses(medication, posology):
+        for minutes in posology_doses(medication, posology, start, end):
+            yield minutes, medication.id, posology.id, medication.name
+
+    current_day = None
+    for minutes, medication_id, posology_id, name in heapq.merge(
+            *(doses(medication, posology) for medication, posologies in medications for posology in posologies)):
+        day, minute = divmod(minutes, MINUTES_PER_DAY)
+        # Rows come sorted by date, the date of a day is formatted once
+        if day != current_day:
+            current_day = day
+            date = (EPOCH + day * DAY).strftime(DATE_FORMAT)
+        yield medication_id, name, posology_id, f"{date}T{minute // 60:02d}:{minute % 60:02d}"
+
+
+def iter_schedule(medications: list[tuple["Medication", list["Posology"]]], start: str, end: str,
+                  batch_size: int = SCHEDULE_BATCH_SIZE):
+    rows = expand_schedule(medications, to_minutes(start), to_minutes(end))
+    while batch := list(itertools.islice(rows, batch_size)):
+        yield batch
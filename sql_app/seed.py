@@ -0,0 +1,173 @@
+import argparse
+import datetime
+import random
+import time
+
+from faker import Faker
+from sqlalchemy import insert
+from sqlmodel import Session
+
+from .catalogue import get_catalogue
+from .dates import DATE_FORMAT, DATETIME_FORMAT, EPOCH, MINUTE
+from .models import Patient, Medication, Posology, Intake
+from .summary import rebuild_daily_adherence
+from .versions import bump_versions
+
+
+DOSAGES = [0.25, 0.5, 0.75, 1, 1.5, 2]
+POSOLOGY_DELTA = [6, 8, 12, 24]
+
+# Medications start in the days after this date
+BASE_START_DATE = datetime.date(2024, 10, 1)
+START_DATE_DAYS = 90
+
+# Probability of a skipped intake
+SKIP_PROBABILITY = 0.2
+
+# Patient names are drawn from this many first names and surnames
+NAME_POOL_SIZE = 1000
+
+
+def insert_rows(connection, table, columns: tuple, rows: list[tuple]):
+    # Plain DBAPI executemany of an INSERT compiled once. The per-row
+    # parameter processing of SQLAlchemy takes longer than the inserts
+    # themselves, so rows have to contain stored values already (see
+    # stored_values)
+    if connection.dialect.driver == "psycopg":
+        # COPY is several times faster than INSERTs in PostgreSQL
+        with connection.connection.cursor() as cursor:
+            with cursor.copy(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+        return
+    compiled = insert(table).compile(dialect=connection.dialect, column_keys=list(columns))
+    if compiled.positiontup is None:
+        rows = [dict(zip(columns, row)) for row in rows]
+    elif tuple(compiled.positiontup) != columns:
+        positions = [columns.index(key) for key in compiled.positiontup]
+        rows = [tuple(row[i] for i in positions) for row in rows]
+    connection.exec_driver_sql(compiled.string, rows)
+
+
+def stored_values(connection, column, convert):
+    # Cache of the values stored for a key, converted with convert() to the
+    # API format and then with the bind processor of the column type (the
+    # epoch types of MEDICATIONS_DATE_STORAGE=integer)
+    processor = column.type.bind_processor(connection.dialect) or (lambda value: value)
+    values = {}
+
+    def stored_value(key):
+        value = values.get(key)
+        if value is None:
+            value = values[key] = processor(convert(key))
+        return value
+    return stored_value
+
+
+def seed_db(db_engine, patients: int = 100, seed: int = 0, intake_days: int = 14,
+            batch_size: int = 1000) -> dict[str, int]:
+    # Generates a synthetic dataset, the same for the same seed and sizes.
+    # Rows are inserted in batches of batch_size patients (with their
+    # medications, posologies and intakes) with multi-row INSERTs, all in
+    # a single transaction
+    medication_names = get_catalogue().names
+    rng = random.Random(seed)
+    # Faker is too slow to be called for every patient
+    fake = Faker()
+    fake.seed_instance(seed)
+    first_names = [fake.first_name() for _ in range(NAME_POOL_SIZE)]
+    last_names = [fake.last_name() for _ in range(NAME_POOL_SIZE)]
+    codes = set()
+    counts = dict.fromkeys(("patients", "medications", "posologies", "intakes"), 0)
+    patient_ids_seeded = []
+    base_minutes = (datetime.datetime.combine(BASE_START_DATE, datetime.time()) - EPOCH) // MINUTE
+
+    with db_engine.begin() as connection:
+        intake_date = stored_values(
+            connection, Intake.__table__.c.date,
+            lambda minutes: (EPOCH + minutes * MINUTE).strftime(DATETIME_FORMAT))
+        for first in range(0, patients, batch_size):
+            patient_rows = []
+            for _ in range(first, min(patients, first + batch_size)):
+                code = rng.randrange(10 ** 9)
+                while code in codes:
+                    code = rng.randrange(10 ** 9)
+                codes.add(code)
+                patient_rows.append({
+                    "code": f"{code // 10 ** 6:03d}-{code // 10 ** 4 % 100:02d}-{code % 10 ** 4:04d}",
+                    "name": rng.choice(first_names),
+                    "surname": rng.choice(last_names),
+                })
+            patient_ids = connection.scalars(
+                insert(Patient).returning(Patient.id, sort_by_parameter_order=True),
+                patient_rows).all()
+
+            medication_rows = []
+            schedules = []
+            for patient_id in patient_ids:
+                for _ in range(rng.randint(1, 5)):
+                    start_day = rng.randrange(START_DATE_DAYS)
+                    medication_rows.append({
+                        "name": rng.choice(medication_names),
+                        "dosage": rng.choice(DOSAGES),
+                        "treatment_duration": rng.randint(5, 100),
+                        "start_date": (BASE_START_DATE + datetime.timedelta(days=start_day)).strftime(DATE_FORMAT),
+                        "patient_id": patient_id,
+                    })
+                    schedules.append((start_day, rng.randrange(24), rng.choice(POSOLOGY_DELTA)))
+            medication_ids = connection.scalars(
+                insert(Medication).returning(Medication.id, sort_by_parameter_order=True),
+                medication_rows).all()
+
+            posology_rows = []
+            intake_rows = []
+            random_value = rng.random
+            for medication_id, (start_day, first_hour, delta) in zip(medication_ids, schedules):
+                for k in range(24 // delta):
+                    hour = (first_hour + k * delta) % 24
+                    posology_rows.append((hour, 0, medication_id))
+                    minutes = base_minutes + start_day * 1440 + hour * 60
+                    for day in range(intake_days):
+                        if random_value() < SKIP_PROBABILITY:
+                            continue
+                        # Taken up to an hour before or after the posology
+                        offset = int(random_value() * 121) - 60
+                        intake_rows.append((intake_date(minutes + day * 1440 + offset), medication_id))
+            insert_rows(connection, Posology.__table__, ("hour", "minute", "medication_id"), posology_rows)
+            if intake_rows:
+                insert_rows(connection, Intake.__table__, ("date", "medication_id"), intake_rows)
+
+            patient_ids_seeded.extend(patient_ids)
+            counts["patients"] += len(patient_ids)
+            counts["medications"] += len(medication_ids)
+            counts["posologies"] += len(posology_rows)
+            counts["intakes"] += len(intake_rows)
+        with Session(bind=connection) as session:
+            rebuild_daily_adherence(session)
+            bump_versions(session, patient_ids_seeded)
+    return counts
+
+
+if __name__ == "__main__":
+    from .database import DB_URL, PROFILES, create_db_engine
+    from .utils import create_db_and_tables
+
+    parser = argparse.ArgumentParser(
+        description="Fill an empty database with a synthetic dataset")
+    parser.add_argument("--url", default=DB_URL,
+                        help="Database URL (default: MEDICATIONS_DB_URL or the local SQLite file)")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--intake-days", type=int, default=14,
+                        help="Days of intakes of every posology")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Patients inserted per batch")
+    args = parser.parse_args()
+
+    db_engine = create_db_engine(args.url, PROFILES["prod"])
+    create_db_and_tables(db_engine)
+    start = time.perf_counter()
+    counts = seed_db(db_engine, patients=args.patients, seed=args.seed,
+                     intake_days=args.intake_days, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(", ".join(f"{count} {table}" for table, count in counts.items()) + f" in {elapsed:.2f}s")
@@ -0,0 +1,183 @@
+import argparse
+import datetime
+from collections import Counter
+
+from sqlalchemy import Integer, case, delete, func, insert, literal, literal_column, select, type_coerce, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session
+
+from .dates import CONVERSIONS, DATE_FORMAT, DATE_STORAGE, DAY, EPOCH
+from .models import DailyAdherence, Medication, Posology, Intake
+
+# The daily adherence summary has a row per medication and day with:
+# - expected: doses of the day, the number of posologies of the medication
+#   on the days of the treatment;
+# - taken: intakes of the medication on that day.
+# The functions of crud.py that change any of them update the rows of the
+# affected days in the same transaction, and rebuild_daily_adherence
+# computes the whole table again from the other tables.
+
+MINUTES_PER_DAY = 1440
+
+
+def date_day(date: str) -> int:
+    # Days since 1970-01-01 of a date or a datetime in the API format
+    return (datetime.datetime.strptime(date[:10], DATE_FORMAT) - EPOCH) // DAY
+
+
+def day_date(day: int) -> str:
+    return (EPOCH + day * DAY).strftime(DATE_FORMAT)
+
+
+def treatment_days(medication: Medication) -> range:
+    first = date_day(medication.start_date)
+    return range(first, first + medication.treatment_duration)
+
+
+def add_counts(session: Session, rows: list[dict], column: str):
+    # Adds the column of the rows to the summary, creating missing rows
+    if len(rows) == 0:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        statement = postgresql.insert(DailyAdherence)
+    else:
+        statement = sqlite.insert(DailyAdherence)
+    statement = statement.on_conflict_do_update(
+        index_elements=[DailyAdherence.medication_id, DailyAdherence.day],
+        set_={column: getattr(DailyAdherence, column) + statement.excluded[column]})
+    session.execute(statement, rows)
+
+
+def add_taken(session: Session, intakes: list[tuple[int, str]], delta: int):
+    # delta is 1 for new intakes and -1 for removed ones
+    counts = Counter((medication_id, date_day(date)) for medication_id, date in intakes)
+    add_counts(session, [
+        {"medication_id": medication_id, "day": day, "expected": 0, "taken": delta * count}
+        for (medication_id, day), count in counts.items()], "taken")
+
+
+def add_expected(session: Session, medication: Medication, delta: int):
+    # delta is the number of posologies added to (or removed from) the
+    # medication
+    add_counts(session, [
+        {"medication_id": medication.id, "day": day, "expected": delta, "taken": 0}
+        for day in treatment_days(medication)], "expected")
+
+
+def reset_expected(session: Session, medication: Medication):
+    # After a change of the treatment days of the medication
+    session.execute(
+        update(DailyAdherence).where(DailyAdherence.medication_id == medication.id).values(expected=0))
+    posologies = session.execute(
+        select(func.count()).select_from(Posology).where(Posology.medication_id == medication.id)).scalar()
+    add_expected(session, medication, posologies)
+
+
+def remove_summary(session: Session, medication_ids):
+    # Before the medications selected by the medication_ids subquery are
+    # deleted
+    session.execute(delete(DailyAdherence).where(DailyAdherence.medication_id.in_(medication_ids)).execution_options(
+        synchronize_session=False))
+
+
+def intake_minutes_expression(dialect: str):
+    # SQL expression of Intake.date in minutes since 1970-01-01
+    if DATE_STORAGE == "integer":
+        return type_coerce(Intake.date, Integer)
+    minutes = CONVERSIONS[dialect]["minutes"].format(column="intake.date")
+    return literal_column(f"({minutes})", Integer)
+
+
+def intake_day_expression(dialect: str):
+    # SQL expression of the day of Intake.date
+    return intake_minutes_expression(dialect) // MINUTES_PER_DAY
+
+
+def start_day_expression(dialect: str):
+    # SQL expression of Medication.start_date in days since 1970-01-01
+    if DATE_STORAGE == "integer":
+        return type_coerce(Medication.start_date, Integer)
+    days = CONVERSIONS[dialect]["days"].format(column="medication.start_date")
+    return literal_column(f"({days})", Integer)
+
+
+def rebuild_daily_adherence(session: Session) -> int:
+    # Computes the whole summary again, in the transaction of the session,
+    # without going through Python: the rows of the days of treatment are
+    # inserted by a single INSERT ... SELECT, joining the medications with
+    # the offsets 0 .. longest treatment - 1, and the intakes of each day
+    # are added to them as in add_counts
+    connection = session.connection()
+    dialect = connection.dialect.name
+    offsets = select(literal(0, Integer).label("offset")).cte("offsets", recursive=True)
+    offsets = offsets.union_all(select(offsets.c.offset + 1).where(
+        offsets.c.offset + 1 < select(func.max(Medication.treatment_duration)).scalar_subquery()))
+    posologies = select(Posology.medication_id, func.count().label("posologies")).group_by(
+        Posology.medication_id).subquery()
+    expected = select(
+        Medication.id, start_day_expression(dialect) + offsets.c.offset, posologies.c.posologies,
+        literal(0, Integer)).select_from(Medication).join(
+        posologies, posologies.c.medication_id == Medication.id).join(
+        offsets, offsets.c.offset < Medication.treatment_duration)
+    day = intake_day_expression(dialect)
+    taken = select(Intake.medication_id, day, literal(0, Integer), func.count()).group_by(Intake.medication_id, day)
+    columns = ["medication_id", "day", "expected", "taken"]
+
+    connection.execute(delete(DailyAdherence))
+    connection.execute(insert(DailyAdherence).from_select(columns, expected))
+    if dialect == "postgresql":
+        statement = postgresql.insert(DailyAdherence)
+    else:
+        statement = sqlite.insert(DailyAdherence)
+    statement = statement.from_select(columns, taken)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[DailyAdherence.medication_id, DailyAdherence.day],
+        set_={"taken": statement.excluded.taken}))
+    return connection.execute(select(func.count()).select_from(DailyAdherence)).scalar()
+
+
+def taken_expression():
+    # Intakes beyond the expected doses of a medication are not counted
+    return case((DailyAdherence.taken < DailyAdherence.expected, DailyAdherence.taken),
+                else_=DailyAdherence.expected)
+
+
+def daily_adherence_statement(**kwargs):
+    # Expected and taken doses by day, for all the patients or for one
+    patient_id = kwargs.get('patient_id', None)
+    start_date = kwargs.get('start_date', None)
+    end_date = kwargs.get('end_date', None)
+    taken = taken_expression()
+    statement = select(DailyAdherence.day, func.sum(DailyAdherence.expected), func.sum(taken)).where(
+        DailyAdherence.expected > 0)
+    if patient_id is not None:
+        statement = statement.where(DailyAdherence.medication_id.in_(
+            select(Medication.id).where(Medication.patient_id == patient_id)))
+    if start_date is not None:
+        statement = statement.where(DailyAdherence.day >= date_day(start_date))
+    if end_date is not None:
+        statement = statement.where(DailyAdherence.day <= date_day(end_date))
+    return statement.group_by(DailyAdherence.day).order_by(DailyAdherence.day)
+
+
+def daily_adherence_result(rows: list[tuple[int, int, int]]) -> list[dict]:
+    return [dict(date=day_date(day), expected=expected, taken=taken,
+                 taken_percentage=round(100 * taken / expected, 2))
+            for day, expected, taken in rows]
+
+
+if __name__ == "__main__":
+    from .database import DB_URL, PROFILES, create_db_engine
+    from .utils import create_db_and_tables
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild the daily adherence summary from the intakes and posologies")
+    parser.add_argument("--url", default=DB_URL,
+                        help="Database URL (default: MEDICATIONS_DB_URL or the local SQLite file)")
+    args = parser.parse_args()
+    db_engine = create_db_engine(args.url, PROFILES["prod"])
+    create_db_and_tables(db_engine)
+    with Session(db_engine) as session:
+        rows = rebuild_daily_adherence(session)
+        session.commit()
+    print(f"Daily adherence summary rebuilt with {rows} rows")
@@ -1,94 +1,132 @@
 from .database import engine
-from .models import Patient, Medication, Posology
-from sqlmodel import SQLModel, text, Session
-from faker import Faker
+from .models import DailyAdherence, PatientVersion
+from .seed import seed_db
+from .summary import rebuild_daily_adherence
+from .versions import initialize_versions
+from sqlalchemy import func, inspect, select, text
+from sqlmodel import SQLModel, Session
+from contextlib import contextmanager
 from .crud import *
-import random
-import json
-import datetime
+import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
-    # Foreign keys are disabled in sqlite3 by default
-    with Session(engine) as session:
-        session.exec(text("PRAGMA foreign_keys = ON"))
+# Patients of the synthetic dataset created in an empty database on
+# startup, 0 to leave it empty
+SEED_PATIENTS = int(os.environ.get("MEDICATIONS_SEED_PATIENTS", "100"))
 
+# Duplicate values listed when a unique index cannot be created
+MAX_DUPLICATES_REPORTED = 20
 
-def init_db():
-    fake = Faker()
-    f = open('medications.json', 'r', encoding='utf8')
-    medications = json.load(f)
-    f.close()
-    dosages = [0.25, 0.5, 0.75, 1, 1.5, 2]
-    posology_delta = [6, 8, 12, 24]
+# Keys of the PostgreSQL advisory locks of db_lock
+DB_LOCK_KEYS = {
+    "schema": 0x6d656473,
+    "seed": 0x6d656474,
+}
 
-    base_intake_date = datetime.datetime(2024, 10, 1)
-    day_delta = datetime.timedelta(days=1)
-    
-    with Session(engine) as session:
 
-        for i in range(100):
-            profile = fake.simple_profile()
-            name = profile['name'].split()
-        
-            patient = Patient(
-                code=fake.ssn(),
-                name=name[0],
-                surname=name[1],
-            )
-            patient = insert_patient(session, patient)
-    
-            for j in range(random.randint(1,5)):
-                name = medications[random.randint(0, len(medications))]['nombre']
-                idx = random.randint(0,len(dosages)-1)
-                start_date = fake.date_between(datetime.datetime(2024,10,1), datetime.datetime.now())
-                medication = Medication(
-                    name=name, 
-                    dosage=dosages[idx],
-                    treatment_duration=random.randint(5, 100), 
-                    start_date=start_date,
-                    patient_id = patient.id,
-                    )
-                medication = insert_medication(session, medication)
-                time_str = fake.time()
-                time = datetime.datetime.strptime(time_str, "%H:%M:%S")
-                idx = random.randint(0, len(posology_delta)-1)
-                rep = int(24/posology_delta[idx])
-                time_delta = datetime.timedelta(hours=posology_delta[idx])
-                for k in range(rep):
-                    posology = Posology(
-                        medication_id = medication.id,
-                        hour=int(time.hour),
-                        minute=0)
-                    insert_posology(session, posology)
+@contextmanager
+def db_lock(db_engine, name: str = "schema", blocking: bool = True):
+    # Lock shared by all the processes using the database, so only one of
+    # the workers of a server creates the tables or seeds the database. An
+    # advisory lock in PostgreSQL and a lock file next to a SQLite database.
+    # Yields whether the lock is held, which without blocking is False if
+    # another process holds it
+    if db_engine.dialect.name == "postgresql":
+        with db_engine.connect() as connection:
+            if blocking:
+                connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": DB_LOCK_KEYS[name]})
+                acquired = True
+            else:
+                acquired = connection.execute(
+                    text("SELECT pg_try_advisory_lock(:key)"), {"key": DB_LOCK_KEYS[name]}).scalar()
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": DB_LOCK_KEYS[name]})
+                connection.commit()
+    elif fcntl is not None and db_engine.url.database not in (None, "", ":memory:"):
+        suffix = ".lock" if name == "schema" else f".{name}.lock"
+        with open(f"{db_engine.url.database}{suffix}", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield True
 
-                    
-                    intake_date = datetime.datetime(
-                        year=start_date.year,
-                        month= start_date.month,
-                        day=start_date.day,   
-                        hour = int(time.hour),
-                        minute = 0 
-                    )
-                    for l in range(14):
-                        r = random.uniform(0,1)
-                        if r < 0.2: # Skip some intakes
-                            print("Skipped intake!")
-                            continue
-                        actual_intake_date = intake_date + datetime.timedelta(minutes=random.randint(-60, 60))
-                        intake = Intake(
-                            medication_id = medication.id,
-                            date=actual_intake_date.strftime("%Y-%m-%dT%H:%M")
-                        )
-                        insert_intake(session, intake)
-                        intake_date += day_delta
-                    time += time_delta
 
-def init_db_if_empty():
-    with Session(engine) as session:
-        patients = find_patient(session)
-        if len(patients) == 0:
-            init_db()
-        else:
-            print("DB not empty")
\ No newline at end of file
+def check_unique(db_engine, index):
+    # A database created before a unique index existed may have duplicate
+    # values, which have to be fixed by hand before the index is created
+    columns = list(index.columns)
+    statement = select(*columns, func.count()).group_by(*columns).having(func.count() > 1).limit(
+        MAX_DUPLICATES_REPORTED)
+    with db_engine.connect() as connection:
+        duplicates = connection.execute(statement).all()
+    if duplicates:
+        values = ", ".join(
+            f"{'/'.join(str(value) for value in row[:-1])} ({row[-1]} rows)" for row in duplicates)
+        raise RuntimeError(
+            f"Cannot create the unique index {index.name}: {index.table.name} has duplicate "
+            f"{', '.join(column.name for column in columns)} values: {values}. "
+            f"Change or delete the duplicate rows and start the server again")
+
+
+def create_db_and_tables(db_engine=engine):
+    with db_lock(db_engine):
+        # The daily adherence summary and the versions of a database
+        # created before they existed are built from the other tables
+        build_summary = not inspect(db_engine).has_table(DailyAdherence.__tablename__)
+        build_versions = not inspect(db_engine).has_table(PatientVersion.__tablename__)
+        SQLModel.metadata.create_all(db_engine)
+        # create_all skips tables that already exist, so indexes added after
+        # a database was created have to be created one by one
+        inspector = inspect(db_engine)
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    check_unique(db_engine, index)
+                index.create(db_engine, checkfirst=True)
+        if build_summary:
+            with Session(db_engine) as session:
+                rebuild_daily_adherence(session)
+                session.commit()
+        if build_versions:
+            with Session(db_engine) as session:
+                initialize_versions(session)
+                session.commit()
+
+
+def init_db(db_engine=engine, patients=SEED_PATIENTS):
+    counts = seed_db(db_engine, patients=patients)
+    print(f"DB seeded with {counts['patients']} patients")
+
+
+def init_db_if_empty(db_engine=engine, patients=SEED_PATIENTS):
+    if patients == 0:
+        return
+    # The workers that do not get the lock start without waiting for the
+    # one seeding the database. Checked again with the lock held, another
+    # worker may have seeded the database in the meantime
+    with db_lock(db_engine, "seed", blocking=False) as acquired:
+        if not acquired:
+            print("DB being seeded by another worker")
+            return
+        with Session(db_engine) as session:
+            if has_patients(session):
+                print("DB not empty")
+                return
+        init_db(db_engine, patients)
\ No newline at end of file
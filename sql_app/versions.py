@@ -0,0 +1,96 @@
+import email.utils
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .models import Medication, Patient, PatientVersion
+
+# Version of the data of each patient: the patient, its medications,
+# posologies and intakes. The functions of crud.py that write any of them
+# bump it in the same transaction, and the GET endpoints of the patient
+# send it as ETag and Last-Modified, so that a poll of unchanged data is
+# answered with a 304 after reading the version alone.
+# The versions of deleted patients are kept, so that a new patient with the
+# same id never repeats an ETag.
+# Last-Modified has a resolution of a second: the updated_at of each version
+# is at least a second after the one of the previous version, even for
+# writes within the same second, so that a Last-Modified is never sent with
+# two versions and If-Modified-Since cannot answer 304 to a stale copy.
+
+
+def bump_versions(session, patient_ids):
+    patient_ids = set(patient_ids)
+    if len(patient_ids) == 0:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        statement = postgresql.insert(PatientVersion)
+        later = func.greatest
+    else:
+        statement = sqlite.insert(PatientVersion)
+        later = func.max
+    statement = statement.on_conflict_do_update(
+        index_elements=[PatientVersion.patient_id],
+        set_={"version": PatientVersion.version + 1,
+              "updated_at": later(statement.excluded.updated_at, PatientVersion.updated_at + 1)})
+    now = int(time.time())
+    session.execute(statement, [
+        {"patient_id": patient_id, "version": 1, "updated_at": now} for patient_id in sorted(patient_ids)])
+
+
+def medication_patient_ids(session, medication_ids) -> set[int]:
+    # Patients whose version a write of intakes or posologies of the
+    # medications bumps
+    medication_ids = set(medication_ids)
+    if len(medication_ids) == 1:
+        medication = session.get(Medication, next(iter(medication_ids)))
+        return {medication.patient_id} if medication is not None else set()
+    return set(session.execute(
+        select(Medication.patient_id).where(Medication.id.in_(medication_ids))).scalars())
+
+
+def initialize_versions(session):
+    # Versions of the patients of a database created before the versions
+    # existed
+    patient_ids = session.execute(select(Patient.id)).scalars().all()
+    bump_versions(session, patient_ids)
+
+
+def find_version(session, patient_id: int):
+    # (version, updated_at) of the patient, or None if it never existed
+    statement = select(PatientVersion.version, PatientVersion.updated_at).where(
+        PatientVersion.patient_id == patient_id)
+    return session.execute(statement).first()
+
+
+def etag_headers(etag: str, updated_at: int | None = None) -> dict:
+    headers = {"ETag": f'"{etag}"'}
+    if updated_at is not None:
+        headers["Last-Modified"] = email.utils.formatdate(updated_at, usegmt=True)
+    # Cached responses are revalidated on every use
+    headers["Cache-Control"] = "no-cache"
+    return headers
+
+
+def version_headers(patient_id: int, version) -> dict | None:
+    # Headers of the responses with data of the patient, None if it never
+    # existed
+    if version is None:
+        return None
+    return etag_headers(f"{patient_id}-{version.version}", version.updated_at)
+
+
+def is_not_modified(request_headers, headers: dict) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or headers["ETag"] in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None and "Last-Modified" in headers:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return email.utils.parsedate_to_datetime(headers["Last-Modified"]) <= since
+    return False
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from .crud import insert_intakes
+from .models import Intake
+
+# Group commit of intakes. POST .../intakes hands its intake to a background
+# writer, which collects the intakes that arrive within
+# MEDICATIONS_GROUP_COMMIT_WINDOW milliseconds, or until there are
+# MEDICATIONS_GROUP_COMMIT_SIZE of them, and inserts them with one multi-row
+# INSERT in a single transaction. Each request waits for the commit and
+# returns the id of its intake, so a 201 still means the intake is stored,
+# for MEDICATIONS_GROUP_COMMIT_TIMEOUT seconds at most. The writer is a
+# single thread, which also serializes the writes of intakes to SQLite, and
+# checks out a connection of the pool for each batch.
+
+# 1 enables the writer, intakes are inserted by each request otherwise
+GROUP_COMMIT = os.environ.get("MEDICATIONS_GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_WINDOW = float(os.environ.get("MEDICATIONS_GROUP_COMMIT_WINDOW", "5"))
+GROUP_COMMIT_SIZE = int(os.environ.get("MEDICATIONS_GROUP_COMMIT_SIZE", "500"))
+GROUP_COMMIT_TIMEOUT = float(os.environ.get("MEDICATIONS_GROUP_COMMIT_TIMEOUT", "10"))
+# full: every commit is flushed to disk before the requests are answered.
+# normal: commits are not flushed one by one (synchronous=NORMAL in SQLite
+# with WAL, synchronous_commit=off in PostgreSQL), so the last ones can be
+# lost with a power failure or a crash of the database server, but the
+# database is never corrupted
+GROUP_COMMIT_DURABILITY = os.environ.get("MEDICATIONS_GROUP_COMMIT_DURABILITY", "full")
+
+DURABILITY_STATEMENTS = {
+    "sqlite": {
+        "full": "PRAGMA synchronous = FULL",
+        "normal": "PRAGMA synchronous = NORMAL",
+    },
+    "postgresql": {
+        "full": "SET synchronous_commit = on",
+        "normal": "SET synchronous_commit = off",
+    },
+}
+
+# Statements restoring the durability of the engine after each batch, for
+# the other users of the connection
+RESTORE_STATEMENTS = {
+    "sqlite": lambda connection: "PRAGMA synchronous = {}".format(
+        connection.exec_driver_sql("PRAGMA synchronous").scalar()),
+    "postgresql": lambda connection: "RESET synchronous_commit",
+}
+
+
+class IntakeWriter:
+
+    def __init__(self, db_engine, window: float = GROUP_COMMIT_WINDOW, size: int = GROUP_COMMIT_SIZE,
+                 durability: str = GROUP_COMMIT_DURABILITY, timeout: float = GROUP_COMMIT_TIMEOUT):
+        if durability not in ("full", "normal"):
+            raise ValueError(f"Invalid durability {durability}, it must be full or normal")
+        self.db_engine = db_engine
+        # In seconds
+        self.window = window / 1000
+        self.size = size
+        self.durability = durability
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.thread = None
+        self.counts = {"intakes": 0, "commits": 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="intake-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # The intakes already submitted are written first
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, intake: Intake) -> Future:
+        # A future of the id of the intake, or of the error inserting it
+        future = Future()
+        self.queue.put((intake, future))
+        return future
+
+    def insert(self, intake: Intake) -> int:
+        # Raises TimeoutError if the intake is not written in time, and then
+        # it is never written. An intake whose batch is being written already
+        # cannot be cancelled, so the result of the batch is awaited instead:
+        # a client told to try again would insert it twice
+        future = self.submit(intake)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    async def insert_async(self, intake: Intake) -> int:
+        # insert() for the event loop
+        future = self.submit(intake)
+        result = asyncio.wrap_future(future)
+        try:
+            # Shielded, the timeout does not cancel the intake by itself
+            return await asyncio.wait_for(asyncio.shield(result), self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return await result
+
+    def next_batch(self) -> tuple[list, bool]:
+        # The intakes of the next transaction, and whether the writer has to
+        # stop after it
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def run(self):
+        stop = False
+        try:
+            while not stop:
+                batch, stop = self.next_batch()
+                # The intakes whose requests gave up waiting are not written,
+                # and the others cannot be cancelled anymore
+                batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+                if batch:
+                    self.write_batch(batch)
+        finally:
+            # Nothing resolves the intakes still queued once the thread ends
+            self.fail_pending(RuntimeError("The intake writer is not running"))
+
+    def fail_pending(self, error: Exception):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(error)
+
+    def write_batch(self, batch: list):
+        # A connection of the pool for each batch, so that a connection lost
+        # only fails the batch, and pool_pre_ping and pool_recycle apply.
+        # The durability is set outside of a transaction, which SQLite
+        # requires, and restored before the connection goes back to the pool
+        try:
+            with self.db_engine.connect() as connection:
+                dialect = connection.dialect.name
+                restore = RESTORE_STATEMENTS[dialect](connection) if dialect in RESTORE_STATEMENTS else None
+                if dialect in DURABILITY_STATEMENTS:
+                    connection.exec_driver_sql(DURABILITY_STATEMENTS[dialect][self.durability])
+                connection.commit()
+                try:
+                    self.write(connection, batch)
+                finally:
+                    if restore is not None:
+                        connection.exec_driver_sql(restore)
+                        connection.commit()
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def write(self, connection, batch: list):
+        try:
+            with Session(bind=connection, expire_on_commit=False) as session:
+                intake_ids = insert_intakes(session, [intake for intake, _ in batch])
+            self.counts["commits"] += 1
+        except IntegrityError as e:
+            # An intake of a medication deleted meanwhile, the others are
+            # inserted one by one so that only its request fails
+            connection.rollback()
+            if len(batch) > 1:
+                for item in batch:
+                    self.write(connection, [item])
+                return
+            batch[0][1].set_exception(e)
+            return
+        except Exception as e:
+            connection.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.counts["intakes"] += len(batch)
+        for (_, future), intake_id in zip(batch, intake_ids):
+            future.set_result(intake_id)